@@ -0,0 +1,142 @@
+import os
+import time
+import uuid
+import atexit
+import bisect
+import socket
+import hashlib
+import threading
+import traceback
+
+from base import settings, logger
+from base.redis_db import get_redis
+from base.constants import DEFAULT_CLUSTER_HEARTBEAT_INTERVAL, DEFAULT_CLUSTER_MEMBER_TTL, \
+    DEFAULT_CLUSTER_VIRTUAL_NODES
+
+CLUSTER_ENABLED = settings.config_cluster.get('enabled', False)
+HEARTBEAT_INTERVAL = settings.config_cluster.get('heartbeat_interval', DEFAULT_CLUSTER_HEARTBEAT_INTERVAL)
+MEMBER_TTL = settings.config_cluster.get('member_ttl', DEFAULT_CLUSTER_MEMBER_TTL)
+VIRTUAL_NODES = settings.config_cluster.get('virtual_nodes', DEFAULT_CLUSTER_VIRTUAL_NODES)
+
+_members = {}
+_members_lock = threading.Lock()
+
+
+def ring_hash(value):
+    return int(hashlib.md5(str(value).encode()).hexdigest()[:16], 16)
+
+
+class ClusterMember:
+    """
+    Membership of this process in a group of manager instances sharing the same redis hash (e.g. all
+    processes running the polling), to split work between them.
+
+    Live members are kept in a redis sorted set scored by expiration time, renewed by a heartbeat thread.
+    Keys (channels, refresh tokens) are assigned to members with a consistent hash ring, so a join or leave
+    only moves the keys of one member. As members may briefly disagree on the ring while it changes, work
+    that must run once is also guarded by short leases (see claim).
+    """
+
+    def __init__(self, group, heartbeat_interval=HEARTBEAT_INTERVAL, member_ttl=MEMBER_TTL,
+                 virtual_nodes=VIRTUAL_NODES):
+        self.group = group
+        self.heartbeat_interval = heartbeat_interval
+        self.member_ttl = max(member_ttl, heartbeat_interval * 2)
+        self.virtual_nodes = virtual_nodes
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.members_key = f"{settings.redis_db}/cluster/{group}/members"
+        self.leases_key = f"{settings.redis_db}/cluster/{group}/leases"
+        self.db = get_redis()
+        self.members = []
+        self.version = 0  # incremented every time members change
+        self._ring = []
+        self._ring_members = []
+        self._thread = None
+
+    def start(self):
+        self.heartbeat()
+        self._thread = threading.Thread(target=self.run, name=f"Cluster-{self.group}", daemon=True)
+        self._thread.start()
+        atexit.register(self.leave)
+
+    def run(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.error(f"[Cluster] {self.group}: heartbeat error {traceback.format_exc(limit=5)}")
+
+    def heartbeat(self):
+        """
+        Renews this member registration and reloads the live members, rebuilding the ring when they change
+        """
+        now = time.time()
+        pipe = self.db.pipeline()
+        pipe.zadd(self.members_key, **{self.node_id: now + self.member_ttl})
+        pipe.zremrangebyscore(self.members_key, '-inf', now)
+        pipe.zrange(self.members_key, 0, -1)
+        members = sorted(pipe.execute()[-1])
+
+        if members != self.members:
+            joined = set(members) - set(self.members)
+            left = set(self.members) - set(members)
+            logger.notice(f"[Cluster] {self.group}: {len(members)} members, joined: {sorted(joined)}, "
+                          f"left: {sorted(left)}")
+            ring = sorted((ring_hash(f"{member}#{n}"), member)
+                          for member in members for n in range(self.virtual_nodes))
+            self._ring = [point for point, _ in ring]
+            self._ring_members = [member for _, member in ring]
+            self.members = members
+            self.version += 1
+
+    def leave(self):
+        try:
+            self.db.zrem(self.members_key, self.node_id)
+            logger.notice(f"[Cluster] {self.group}: {self.node_id} left")
+        except Exception:
+            logger.error(f"[Cluster] {self.group}: error leaving {traceback.format_exc(limit=5)}")
+
+    def owner(self, key):
+        if not self._ring:
+            return self.node_id
+        index = bisect.bisect(self._ring, ring_hash(key)) % len(self._ring)
+        return self._ring_members[index]
+
+    def owns(self, key):
+        return self.owner(key) == self.node_id
+
+    def claim(self, leases):
+        """
+        Takes leases, as a dict key: seconds, not held by other members. Returns the keys claimed
+        """
+        if not leases:
+            return []
+        keys = list(leases)
+        pipe = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(f"{self.leases_key}/{key}", self.node_id, px=max(int(leases[key] * 1000), 1), nx=True)
+        results = pipe.execute()
+
+        claimed = [key for key, result in zip(keys, results) if result]
+        held = [key for key, result in zip(keys, results) if not result]
+        if held:  # leases already held by this member are still ours
+            pipe = self.db.pipeline(transaction=False)
+            for key in held:
+                pipe.get(f"{self.leases_key}/{key}")
+            claimed.extend(key for key, holder in zip(held, pipe.execute()) if holder == self.node_id)
+        return claimed
+
+
+def get_cluster_member(group):
+    """
+    Returns the started cluster member of this process for group, or None if clustering is disabled
+    """
+    if not CLUSTER_ENABLED:
+        return None
+    with _members_lock:
+        if group not in _members:
+            member = ClusterMember(group)
+            member.start()
+            _members[group] = member
+        return _members[group]
@@ -139,6 +139,14 @@ class SkeletonBase(ABC):
         credentials_list = self.db.full_query('credential-owners/*/channels/*')
         return credentials_list
 
+    def iter_all_credentials(self, fields=None):
+        """
+        Iterate over existing credentials with corresponding key, without loading them all in memory
+            fields - if set, only these credentials fields are kept, e.g. ['expiration_date', 'refresh_token']
+
+        """
+        return self.db.iter_full_query('credential-owners/*/channels/*', fields=fields)
+
     def store(self, key, value):
         """
         To store a value to database with a unique identifier called key
@@ -1,9 +1,27 @@
 # manufacturer's api request
 DEFAULT_RATE_LIMIT = 1  # 1/second
+DEFAULT_RATE_BURST = 1  # requests allowed at once before being limited
 DEFAULT_THREAD_MAX_WORKERS = 2
 
 # polling
 DEFAULT_POLLING_INTERVAL = 60  # 60 seconds
+POLLING_ENGINE_THREADS = 'threads'
+POLLING_ENGINE_ASYNC = 'async'  # requires aiohttp
+DEFAULT_POLLING_ENGINE = POLLING_ENGINE_THREADS
+DEFAULT_POLLING_CONCURRENCY = 20  # channels polled at the same time (async engine)
+DEFAULT_POLLING_CONNECTIONS_PER_HOST = 10  # keep-alive connections per host (async engine)
+DEFAULT_POLLING_REQUEST_TIMEOUT = 30  # 30 seconds
+POLLING_SCHEDULE_STAGGERED = 'staggered'  # each channel polled on its own due time
+POLLING_SCHEDULE_BURST = 'burst'  # all channels polled at once, then sleeps interval_seconds
+DEFAULT_POLLING_SCHEDULE = POLLING_SCHEDULE_STAGGERED
+DEFAULT_POLLING_JITTER = 1.0  # fraction of each channel slot randomized
+DEFAULT_POLLING_MIN_INTERVAL = 10  # 10 seconds, adaptive polling
+DEFAULT_POLLING_MAX_INTERVAL = 3600  # 1 hour, adaptive polling
+DEFAULT_POLLING_BACKOFF = 2  # adaptive polling interval factor
+POLLING_VALIDATORS_MEMORY = 'memory'  # ETag/Last-Modified of conditional requests kept by each process
+POLLING_VALIDATORS_REDIS = 'redis'  # ... or shared in redis
+DEFAULT_POLLING_VALIDATORS_STORE = POLLING_VALIDATORS_MEMORY
+DEFAULT_POLLING_TRACKED_PAYLOADS = 100000  # channel endpoints whose payload hash is kept (adaptive/deduplicate)
 
 # refresh token
 DEFAULT_REFRESH_INTERVAL = 60  # 60 seconds
@@ -12,9 +30,55 @@ DEFAULT_BEFORE_EXPIRES = 300  # 300 seconds
 # Retry connection
 DEFAULT_RETRY_WAIT = 2  # 2 seconds
 
+# redis connection pool (per process)
+DEFAULT_REDIS_MAX_CONNECTIONS = 50
+DEFAULT_REDIS_POOL_TIMEOUT = 20  # seconds waiting for a free connection
+DEFAULT_REDIS_HEALTH_CHECK_INTERVAL = 30  # idle seconds before checking a connection
+
+# cluster of manager instances
+DEFAULT_CLUSTER_HEARTBEAT_INTERVAL = 10  # 10 seconds
+DEFAULT_CLUSTER_MEMBER_TTL = 30  # 30 seconds without heartbeat before a member is considered gone
+DEFAULT_CLUSTER_VIRTUAL_NODES = 128  # points of each member in the hash ring
+DEFAULT_CLUSTER_RETRY_INTERVAL = 10  # seconds before joining again after failing to (e.g. redis unavailable)
+
+# redis queries
+DEFAULT_SCAN_BATCH_SIZE = 1000  # hash fields read per HSCAN/SSCAN round trip
+
+# redis lookup cache
+DEFAULT_CACHE_MAX_SIZE = 10000  # entries
+DEFAULT_CACHE_TTL = 300  # 300 seconds
+
 # mqtt
-DEFAULT_MIN_TIMEOUT = 0.5
-DEFAULT_MAX_TIMEOUT = 2
+MESSAGE_HANDOFF_RAW = 'raw'  # topic and payload bytes are queued, parsed by the subscriber processes
+MESSAGE_HANDOFF_PARSED = 'parsed'  # payloads are parsed by the mqtt network thread before being queued
+DEFAULT_MESSAGE_HANDOFF = MESSAGE_HANDOFF_RAW
+DEFAULT_SUBSCRIBE_CONCURRENCY = 4  # messages handled at the same time by each subscriber process
+DEFAULT_SUBSCRIBE_BLOCK_TIMEOUT = 5  # seconds waiting for a message before checking for shutdown
+DEFAULT_SUBSCRIBE_METRICS_INTERVAL = 60  # seconds between metrics logs, 0 to disable
+DEFAULT_MQTT_CONNECTIONS = 1
+DEFAULT_SUBSCRIBE_QOS = 0
+DEFAULT_PUBLISH_QOS = 0
+DEFAULT_MAX_INFLIGHT_MESSAGES = 20  # qos > 0 publishes waiting for their ack, per connection
+DEFAULT_MAX_QUEUED_MESSAGES = 0  # publishes waiting to be sent, per connection, 0 for unlimited
+DEFAULT_PUBLISH_ACK_WINDOW = 10000  # last acks used for latency percentiles
+DEFAULT_PUBLISH_ACK_TIMEOUT = 60  # seconds before a publish without ack is counted as expired
+DEFAULT_PUBLISH_WORKERS = 4
+DEFAULT_TOPIC_CACHE_SIZE = 10000  # (channel, component, property) publish topics kept
+DEFAULT_PUBLISH_HIGH_WATER_MARK = 10000  # publishes waiting in queue before producers block
+DEFAULT_PUBLISH_BATCH_SIZE = 1  # publishes handed to a worker at once
+DEFAULT_PUBLISH_COALESCE_WINDOW = 0  # seconds publishes of the same case are coalesced, 0 to disable
+DEFAULT_PUBLISH_LAST_VALUES_SIZE = 100000  # last published values kept to drop unchanged ones
+DEFAULT_PUBLISH_METRICS_INTERVAL = 60  # seconds between metrics logs, 0 to disable
+
+# logging
+LOG_MODE_SYNC = 'sync'  # records are formatted and written by the thread logging them
+LOG_MODE_QUEUE = 'queue'  # records are queued, formatted and written by a listener thread
+DEFAULT_LOG_MODE = LOG_MODE_SYNC
+DEFAULT_LOG_QUEUE_SIZE = 10000  # records waiting to be written in queue mode
+LOG_OVERFLOW_DROP_NEW = 'drop_new'  # records logged while the queue is full are dropped
+LOG_OVERFLOW_DROP_OLD = 'drop_old'  # the oldest record waiting is dropped for the new one
+LOG_OVERFLOW_BLOCK = 'block'  # the thread logging waits for room in the queue
+DEFAULT_LOG_OVERFLOW = LOG_OVERFLOW_DROP_NEW
 
 # tcp
 DEFAULT_CONNECTION_TIMEOUT = 60
@@ -43,7 +107,14 @@ HEARTBEAT_PROP = 'heartbeat'
 DEFAULT_THREAD_POOL_LIMIT = 1
 DEFAULT_THREAD_POOL_NAME = "Main-Async"
 DEFAULT_THREAD_KEY_NAME = 'poolthread/queues/'
-DEFAULT_SLEEP_TIME = 5
+DEFAULT_SLEEP_TIME = 5  # poll dispatch mode only
+DISPATCH_NOTIFY = 'notify'  # threads block on the queue and start tasks as soon as they are pushed
+DISPATCH_POLL = 'poll'  # threads check the queue every DEFAULT_SLEEP_TIME seconds
+DEFAULT_DISPATCH_MODE = DISPATCH_NOTIFY
+DEFAULT_BATCH_SIZE = 1  # tasks a thread takes at once, the next ones wait for the previous to finish
+DEFAULT_BLOCK_TIMEOUT = 5  # seconds waiting for a task before checking for expired ones
+DEFAULT_VISIBILITY_TIMEOUT = 600  # seconds before a task not acknowledged is delivered again
+DEFAULT_MAX_DELIVERIES = 3
 
 # Quotes
 QUOTE_URI = "{api_server_full}/applications/{client_id}/quotes/{quote_id}"
@@ -69,6 +69,10 @@ class ValidationException(Exception):
     pass
 
 
+class TaskCancelledException(Exception):
+    pass
+
+
 class InvalidUsage(Exception):
     status_code = 400
 
@@ -1,3 +1,4 @@
+import atexit
 import logging
 import time
 import threading
@@ -6,6 +7,7 @@ from base import python_logging as pl
 from base.settings import Settings
 from base.exceptions import InvalidUsage
 from base.utils import get_real_logger_level
+from base.constants import DEFAULT_LOG_MODE, DEFAULT_LOG_QUEUE_SIZE, DEFAULT_LOG_OVERFLOW, LOG_MODE_QUEUE
 
 settings = Settings()
 
@@ -50,7 +52,22 @@ logging.setLoggerClass(LoggerBase)
 
 logger = logging.getLogger(__name__)
 logger.log_type = log_type
-logger.addHandler(logger_handler)
+logger.setLevel(log_level)
+
+log_mode = settings.config_log.get('mode', DEFAULT_LOG_MODE)
+if log_mode == LOG_MODE_QUEUE:
+    queue_handler, log_listener = pl.setup_queue_handler(
+        logger_handler,
+        settings.config_log.get('queue_size', DEFAULT_LOG_QUEUE_SIZE),
+        settings.config_log.get('overflow', DEFAULT_LOG_OVERFLOW),
+        escape=log_type == 'json'
+    )
+    logger.queued = True
+    logger.addHandler(queue_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+else:
+    logger.addHandler(logger_handler)
 
 LOG_TABLE = {
             0: logger.emergency,
@@ -0,0 +1,127 @@
+import os
+import time
+import threading
+import traceback
+from collections import OrderedDict
+
+from base import logger
+
+CLEAR_ALL = '*'
+
+
+class LookupCache:
+    """
+    In-process LRU cache, with TTL, of raw hash values.
+
+    Entries are invalidated in every process through a redis pub/sub channel: writers publish the changed key
+    (see DBManager.set_key) and each process runs a listener thread evicting it. The cache is cleared whenever
+    the listener is (re)connected, since invalidations may have been missed meanwhile.
+    """
+
+    def __init__(self, max_size, ttl, channel, redis_factory):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = channel
+        self._redis_factory = redis_factory
+        self._pid = None
+        self._listener_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self._listening = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._listener_lock:  # threads using the cache for the first time start a single listener
+            if self._pid == os.getpid():
+                return
+            # first use in this process (e.g. after a fork): inherited entries and listener can't be trusted
+            self._reset()
+            listener = threading.Thread(target=self._listen, name="LookupCacheListener", daemon=True)
+            listener.start()
+            self._pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis_factory().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.clear()
+                self._listening = True
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        self.invalidate(message['data'])
+            except Exception:
+                logger.error(f"[LookupCache] Invalidation listener error: {traceback.format_exc(limit=5)}")
+            self._listening = False
+            self.clear()
+            time.sleep(1)
+
+    @property
+    def version(self):
+        """ Read before fetching a value from redis and pass it to set, to not cache values invalidated meanwhile """
+        self._ensure_listener()
+        return self._version
+
+    def get(self, key):
+        """ Returns (found, value) """
+        self._ensure_listener()
+        if not self._listening:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+        return False, None
+
+    def set(self, key, value, version):
+        self._ensure_listener()
+        if not self._listening:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        if key == CLEAR_ALL:
+            self.clear()
+            return
+        with self._lock:
+            self._version += 1
+            self.invalidations += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'listening': self._listening,
+        }
@@ -0,0 +1,150 @@
+import time
+import queue
+import signal
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from base import settings, logger
+from base.constants import DEFAULT_SUBSCRIBE_CONCURRENCY, DEFAULT_SUBSCRIBE_BLOCK_TIMEOUT, \
+    DEFAULT_SUBSCRIBE_METRICS_INTERVAL
+
+SUBSCRIBE_CONCURRENCY = max(int(settings.config_mqtt.get('subscribe_concurrency', DEFAULT_SUBSCRIBE_CONCURRENCY)), 1)
+SUBSCRIBE_BLOCK_TIMEOUT = settings.config_mqtt.get('subscribe_block_timeout', DEFAULT_SUBSCRIBE_BLOCK_TIMEOUT)
+SUBSCRIBE_METRICS_INTERVAL = settings.config_mqtt.get('subscribe_metrics_interval',
+                                                      DEFAULT_SUBSCRIBE_METRICS_INTERVAL)
+
+
+class MessageConsumer:
+    """
+    Consumes the mqtt messages queued by MqttConnector.on_message, parsed ({'type': ..., 'topic': ...,
+    'payload': ...}) or raw (topic, payload bytes, enqueue time), handling up to concurrency of them at the same
+    time in a pool of threads.
+
+    A message is only taken from the queue when a thread is free to handle it, so messages stay available
+    to the other subscriber processes meanwhile. The consumer stops on a None message (see stop_consumers)
+    or SIGTERM, after the messages being handled finish.
+    """
+
+    def __init__(self, mqtt_instance, message_queue, concurrency=SUBSCRIBE_CONCURRENCY,
+                 block_timeout=SUBSCRIBE_BLOCK_TIMEOUT, metrics_interval=SUBSCRIBE_METRICS_INTERVAL):
+        self.mqtt = mqtt_instance
+        self.queue = message_queue
+        self.concurrency = concurrency
+        self.block_timeout = block_timeout
+        self.metrics_interval = metrics_interval
+        self.stop_event = threading.Event()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._counters = {
+            'handled': 0,
+            'ignored': 0,
+            'failed': 0,
+            'queue_time': 0.0,
+            'max_queue_time': 0.0,
+            'run_time': 0.0,
+            'max_run_time': 0.0
+        }
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def stop(self, *args):
+        """ Stops taking messages, also used as SIGTERM handler """
+        self.stop_event.set()
+
+    def get_handler(self, item):
+        if item['type'] == 'device':
+            return self.mqtt.on_message_manager
+        return self.mqtt.on_message_application
+
+    def run(self):
+        logger.notice(f"[Consumer] Starting, concurrency {self.concurrency}")
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+        if self.metrics_interval:
+            threading.Thread(target=self.log_metrics, name='Consumer-metrics', daemon=True).start()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='onMessage') as executor:
+            while not self.stopped:
+                self._slots.acquire()
+                try:
+                    item = self.queue.get(timeout=self.block_timeout)
+                except queue.Empty:
+                    self._slots.release()
+                    continue
+                except Exception:
+                    self._slots.release()
+                    logger.error(f"[Consumer] Unexpected error getting message: {traceback.format_exc(limit=5)}")
+                    self.stop_event.wait(self.block_timeout)
+                    continue
+
+                if item is None:
+                    self._slots.release()
+                    break
+                executor.submit(self.handle, item)
+        logger.notice(f"[Consumer] Stopped, metrics: {self.metrics()}")
+
+    def handle(self, item):
+        start = time.time()
+        raw = isinstance(item, tuple)  # raw handoff: (topic, payload bytes, enqueued_at)
+        topic, enqueued_at = (item[0], item[2]) if raw else (item['topic'], item.get('enqueued_at'))
+        result = 'handled'
+        try:
+            if raw:
+                item = self.mqtt.parse_message(*item)
+            if item:
+                self.get_handler(item)(item['topic'], item['payload'])
+            else:
+                result = 'ignored'
+        except Exception:
+            result = 'failed'
+            logger.error(f"[Consumer] Unexpected error handling message: {traceback.format_exc(limit=5)}")
+        finally:
+            self._slots.release()
+
+        end = time.time()
+        queue_time = start - (enqueued_at or start)
+        if logger.is_enabled('DEBUG'):
+            logger.debug(f"[Consumer] {result.capitalize()} {topic}, queued {queue_time:.3f}s, "
+                         f"run {end - start:.3f}s")
+        with self._lock:
+            counters = self._counters
+            counters[result] += 1
+            counters['queue_time'] += queue_time
+            counters['max_queue_time'] = max(counters['max_queue_time'], queue_time)
+            counters['run_time'] += end - start
+            counters['max_run_time'] = max(counters['max_run_time'], end - start)
+
+    def metrics(self):
+        """
+        Returns the handled, ignored (not read or write requests) and failed counters of this process, with the
+        average and max time messages waited in queue (queue_time) and took to handle (run_time)
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        total = counters['handled'] + counters['ignored'] + counters['failed']
+        return {
+            'handled': counters['handled'],
+            'ignored': counters['ignored'],
+            'failed': counters['failed'],
+            'avg_queue_time': counters['queue_time'] / total if total else 0.0,
+            'max_queue_time': counters['max_queue_time'],
+            'avg_run_time': counters['run_time'] / total if total else 0.0,
+            'max_run_time': counters['max_run_time']
+        }
+
+    def log_metrics(self):
+        while not self.stop_event.wait(self.metrics_interval):
+            logger.info(f"[Consumer] Metrics: {self.metrics()}")
+
+
+def stop_consumers(message_queue, processes, timeout=None):
+    """
+    Asks the consumers of message_queue running in processes to stop, waiting up to timeout for each one
+    """
+    for _ in processes:
+        message_queue.put(None)
+    for process in processes:
+        process.join(timeout)
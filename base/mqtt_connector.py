@@ -1,15 +1,30 @@
 import os
 import json
+import time
+import zlib
+import threading
 import traceback
+from functools import lru_cache
 import paho.mqtt.client as paho
 from tenacity import retry, wait_fixed
 
 from base import settings, logger
-from base.redis_db import get_redis
+from base.redis_db import get_redis, json_dumps
+from base.publish_tracker import PublishTracker
 from base.utils import format_str
 from base.constants import *
 from base.exceptions import *
 
+MESSAGE_HANDOFF = settings.config_mqtt.get('message_handoff', DEFAULT_MESSAGE_HANDOFF)
+TOPIC_CACHE_SIZE = settings.config_mqtt.get('topic_cache_size', DEFAULT_TOPIC_CACHE_SIZE)
+CONNECTIONS = max(int(settings.config_mqtt.get('connections', DEFAULT_MQTT_CONNECTIONS)), 1)
+SHARED_SUBSCRIPTION = settings.config_mqtt.get('shared_subscription', False)
+SHARED_SUBSCRIPTION_GROUP = settings.config_mqtt.get('shared_subscription_group', settings.client_id)
+SUBSCRIBE_QOS = settings.config_mqtt.get('subscribe_qos', DEFAULT_SUBSCRIBE_QOS)
+PUBLISH_QOS = settings.config_mqtt.get('publish_qos', DEFAULT_PUBLISH_QOS)
+MAX_INFLIGHT_MESSAGES = settings.config_mqtt.get('max_inflight_messages', DEFAULT_MAX_INFLIGHT_MESSAGES)
+MAX_QUEUED_MESSAGES = settings.config_mqtt.get('max_queued_messages', DEFAULT_MAX_QUEUED_MESSAGES)
+
 RC_LIST = {
     0: "Connection successful",
     1: "Connection refused - incorrect protocol version",
@@ -20,25 +35,52 @@ RC_LIST = {
 }
 
 
+@lru_cache(maxsize=TOPIC_CACHE_SIZE)
+def property_topic(channel_id, component, property):
+    return "/{api_version}/channels/{channel_id}/components/{component}/properties/{property}/value".format(
+        api_version=settings.api_version,
+        channel_id=channel_id,
+        component=component,
+        property=property
+    )
+
+
 class MqttConnector:
 
     def __init__(self, client_id=None, access_token=None, implementer=None, queue=None, queue_pub=None, subscribe=True,
-                 **kwargs):
+                 connections=CONNECTIONS, shared_subscription=SHARED_SUBSCRIPTION, **kwargs):
+        """
+        Opens connections mqtt connections, each one with its own network thread and reconnection. Publishes
+        are split between connections by channel. Messages are received by all connections subscribing to a
+        shared subscription if shared_subscription, otherwise by the first connection only.
+        """
         logger.debug("Mqtt - Init")
-        self.mqtt_client = paho.Client()
-        self.mqtt_client.enable_logger()
-
-        self.mqtt_client.on_connect = self.on_connect if 'on_connect' not in kwargs else kwargs['on_connect']
-        self.mqtt_client.on_subscribe = self.on_subscribe if 'on_subscribe' not in kwargs else kwargs['on_subscribe']
-        self.mqtt_client.on_message = self.on_message if 'on_message' not in kwargs else kwargs['on_message']
-        self.mqtt_client.on_disconnect = self.on_disconnect if 'on_disconnect' not in kwargs else kwargs['on_disconnect']
-        self.mqtt_client.on_publish = self.on_publish if 'on_publish' not in kwargs else kwargs['on_publish']
+        self.mqtt_clients = []
+        for n in range(connections):
+            mqtt_client = paho.Client(userdata=n)
+            mqtt_client.enable_logger()
+            mqtt_client.max_inflight_messages_set(MAX_INFLIGHT_MESSAGES)
+            mqtt_client.max_queued_messages_set(MAX_QUEUED_MESSAGES)
+
+            mqtt_client.on_connect = self.on_connect if 'on_connect' not in kwargs else kwargs['on_connect']
+            mqtt_client.on_subscribe = self.on_subscribe if 'on_subscribe' not in kwargs else kwargs['on_subscribe']
+            mqtt_client.on_message = self.on_message if 'on_message' not in kwargs else kwargs['on_message']
+            mqtt_client.on_disconnect = self.on_disconnect if 'on_disconnect' not in kwargs else kwargs['on_disconnect']
+            mqtt_client.on_publish = self.on_publish if 'on_publish' not in kwargs else kwargs['on_publish']
+            self.mqtt_clients.append(mqtt_client)
+        self.mqtt_client = self.mqtt_clients[0]
+        self.shared_subscription = shared_subscription and connections > 1
+        self._counters = [{'received': 0, 'published': 0, 'failed': 0, 'disconnections': 0}
+                          for _ in self.mqtt_clients]
+        self._counters_lock = threading.Lock()
+        self.publish_tracker = PublishTracker()
         self._topics = []
         self._on_connect_callback = None
         self._on_connect_callback_params = {}
 
         self.client_id = client_id if client_id else settings.client_id
-        self.access_token = access_token if access_token else settings.block["access_token"]
+        self._access_token = access_token
+        self._configured_token = None
 
         self.db = get_redis()
         self.implementer = implementer
@@ -46,24 +88,23 @@ class MqttConnector:
         self.queue_pub = queue_pub
         self.subscribe = subscribe
 
+    @property
+    def access_token(self):
+        """ The token given on init, or else the current platform token """
+        return self._access_token or settings.block["access_token"]
+
     def on_connect(self, client, userdata, flags, rc):
         try:
             if rc == 0:
                 logger.debug("Mqtt - Connected , result code {}".format(rc))
 
-                topic = "/{api_version}/{mqtt_topic}/{client_id}/channels/#".format(
-                    mqtt_topic=settings.mqtt_topic,
-                    api_version=settings.api_version,
-                    client_id=settings.client_id
-                )
-
-                if self.subscribe:
+                if self.subscribes(userdata):
+                    topic = self.subscription_topic
+                    logger.notice("Mqtt - Connection {} will subscribe to {}".format(userdata, topic))
+                    client.subscribe(topic, qos=SUBSCRIBE_QOS)
 
-                    logger.notice("Mqtt - Will subscribe to {}".format(topic))
-                    self.mqtt_client.subscribe(topic, qos=0)
-
-                    if self._on_connect_callback:
-                        self._on_connect_callback.__call__(**self._on_connect_callback_params)
+                if self.subscribe and userdata == 0 and self._on_connect_callback:
+                    self._on_connect_callback.__call__(**self._on_connect_callback_params)
 
             elif 0 < rc < 6:
                 raise Exception(RC_LIST[rc])
@@ -71,6 +112,21 @@ class MqttConnector:
             logger.error("Mqtt Exception- {}".format(traceback.format_exc(limit=5)))
             os._exit(1)
 
+    @property
+    def subscription_topic(self):
+        topic = "/{api_version}/{mqtt_topic}/{client_id}/channels/#".format(
+            mqtt_topic=settings.mqtt_topic,
+            api_version=settings.api_version,
+            client_id=settings.client_id
+        )
+        if self.shared_subscription:
+            topic = "$share/{}/{}".format(SHARED_SUBSCRIPTION_GROUP, topic)
+        return topic
+
+    def subscribes(self, connection):
+        """ With a shared subscription every connection subscribes, otherwise only the first one """
+        return self.subscribe and (self.shared_subscription or connection == 0)
+
     def on_subscribe(self, client, userdata, mid, granted_qos):
         logger.info("Mqtt - Subscribed , mid({mid}) qos({granted_qos})".format(mid=mid, granted_qos=granted_qos))
 
@@ -98,10 +154,11 @@ class MqttConnector:
 
                 if all(k in payload for k in ("on_behalf_of", "sender")):
 
-                    logger.debug(
-                        "\n\n\n\n\n\t\t\t\t\t******************* ON MESSAGE ****************************")
-                    logger.debug("Mqtt - Received on_message_manager: {}\n{}".format(
-                        topic, json.dumps(payload, indent=4, sort_keys=True)))
+                    if logger.is_enabled('DEBUG'):
+                        logger.debug(
+                            "\n\n\n\n\n\t\t\t\t\t******************* ON MESSAGE ****************************")
+                        logger.debug("Mqtt - Received on_message_manager: {}\n{}".format(
+                            topic, json.dumps(payload, indent=4, sort_keys=True)))
 
                     device_id = self.db.get_device_id(parts[5])
 
@@ -227,34 +284,51 @@ class MqttConnector:
     def on_message(self, client, userdata, msg):
 
         try:
+            self._counters[userdata]['received'] += 1  # only updated by the connection network thread
+            if MESSAGE_HANDOFF == MESSAGE_HANDOFF_RAW:
+                self.queue.put((msg.topic, msg.payload, time.time()))
+                return
+
+            data = self.parse_message(msg.topic, msg.payload, time.time())
+            if data:
+                self.queue.put(data)
+
+        except Exception:
+            logger.error("Mqtt - Failed to handle payload. {}".format(traceback.format_exc(limit=5)))
 
-            topic = msg.topic
-            payload = json.loads(msg.payload.decode("utf-8"))
+    def parse_message(self, topic, payload, enqueued_at=None):
+        """
+        Returns a received message as handled by the subscriber processes, a dict with keys 'type', 'topic',
+        'payload' and 'enqueued_at', or None if it's not a read or write request
+            payload - message payload (json bytes)
+        """
+        payload = json.loads(payload)
 
+        if logger.is_enabled('DEBUG'):
             logger.debug("\n\n\n\n\n\t\t\t\t\t******************* ON MESSAGE ****************************")
             logger.debug("Mqtt - Received on_message {topic} {payload}".format(
                 topic=topic, payload=format_str(payload, is_json=True)))
 
-            data = {
+        if "io" in payload and payload["io"] in ("r", "w"):
+            return {
                 "type": settings.implementor_type,
                 "topic": topic,
-                "payload": payload
+                "payload": payload,
+                "enqueued_at": enqueued_at
             }
-            if "io" in payload and payload["io"] in ("r", "w"):
-                self.queue.put(data)
-
-
-        except Exception:
-            logger.error("Mqtt - Failed to handle payload. {}".format(traceback.format_exc(limit=5)))
+        return None
 
     def on_publish(self, client, userdata, mid):
+        self.publish_tracker.acknowledged(userdata, mid)
         logger.debug("\n\n\n\n\n\t\t\t\t\t******************* ON PUBLISH ****************************")
         logger.verbose("Mqtt - Publish acknowledged by broker, mid({}) userdata={}.".format(mid, userdata))
 
     def on_disconnect(self, client, userdata, rc):
         if rc != 0:
-            logger.error("Mqtt - Unexpected disconnection: {}".format(RC_LIST.get(rc)))
-            self.mqtt_config()
+            logger.error("Mqtt - Connection {} unexpected disconnection: {}".format(userdata, RC_LIST.get(rc)))
+            with self._counters_lock:
+                self._counters[userdata]['disconnections'] += 1
+            self.connect_client(client)
         else:
             logger.error("Mqtt - Expected disconnection.")
 
@@ -262,14 +336,26 @@ class MqttConnector:
         logger.debug("Mqtt - Paho log: {}".format(buf))
 
     def reconfig(self):
+        """
+        Sets the client credentials, if the platform token changed since they were last set
+        """
+        access_token = self.access_token
+        if access_token == self._configured_token:
+            return
         try:
-            self.mqtt_client.username_pw_set(username=self.client_id, password=self.access_token)
+            for mqtt_client in self.mqtt_clients:
+                mqtt_client.username_pw_set(username=self.client_id, password=access_token)
+            self._configured_token = access_token
         except Exception:
             logger.error(f"Unexpected error reconfig: {traceback.format_exc(limit=5)}")
             raise
 
-    @retry(wait=wait_fixed(DEFAULT_RETRY_WAIT))
     def mqtt_config(self):
+        for mqtt_client in self.mqtt_clients:
+            self.connect_client(mqtt_client)
+
+    @retry(wait=wait_fixed(DEFAULT_RETRY_WAIT))
+    def connect_client(self, mqtt_client):
         logger.info("Setting up Mqtt connection")
         try:
             parts = settings.block["mqtt_ep"].split(":")
@@ -278,27 +364,49 @@ class MqttConnector:
             host = parts[1].replace("//", "")
             port = int(parts[2])
 
-            self.mqtt_client.username_pw_set(username=self.client_id, password=self.access_token)
+            self._configured_token = None
+            self.reconfig()
 
             try:
 
-                logger.debug("mqtt_client._ssl = {}".format(self.mqtt_client._ssl))
+                logger.debug("mqtt_client._ssl = {}".format(mqtt_client._ssl))
 
-                if not self.mqtt_client._ssl and schema_mqtt == "mqtts":
+                if not mqtt_client._ssl and schema_mqtt == "mqtts":
                     logger.debug("Will set tls")
-                    self.mqtt_client.tls_set(ca_certs=settings.cert_path)
+                    mqtt_client.tls_set(ca_certs=settings.cert_path)
 
             except Exception:
                 logger.alert("Mqtt - Failed to authenticate SSL certificate, {}".format(traceback.format_exc(limit=5)))
                 raise
 
-            self.mqtt_client.connect(host, port)
+            mqtt_client.connect(host, port)
             logger.debug( "Mqtt - Did start connect w/ host:{} and port:{}".format(host, port))
 
         except Exception:
             logger.emergency("Unexpected error: {}".format(traceback.format_exc(limit=5)))
             raise
 
+    def loop_start(self):
+        for mqtt_client in self.mqtt_clients:
+            mqtt_client.loop_start()
+
+    def get_client(self, channel_id):
+        """ Returns the index and client of the connection publishing the values of channel_id """
+        n = zlib.crc32(str(channel_id).encode()) % len(self.mqtt_clients) if len(self.mqtt_clients) > 1 else 0
+        return n, self.mqtt_clients[n]
+
+    def metrics(self):
+        """
+        Returns the received, published and failed messages and disconnections, of all connections and of each
+        one (connections), with the publishes acknowledgement metrics (acks, see PublishTracker.metrics)
+        """
+        with self._counters_lock:
+            connections = [dict(counters) for counters in self._counters]
+        metrics = {counter: sum(counters[counter] for counters in connections) for counter in connections[0]}
+        metrics['connections'] = connections
+        metrics['acks'] = self.publish_tracker.metrics()
+        return metrics
+
     def publisher(self, io, data, case=None):
         """
         Receives 3 inputs,
@@ -306,61 +414,87 @@ class MqttConnector:
             data  - data to be published
             case  - if topic not available, a dictionary used to construct the topic from 
                     keys 'device_id' or 'channel_id', 'component' and 'property'
+        Returns True if published
+        """
+        try:
+            self.reconfig()
+            return self.publish(io, data, case)
+        except Exception as e:
+            logger.alert("Mqtt - Failed to publish , ex {}".format(e))
+            return False
+
+    def publish_batch(self, items):
+        """
+        Publishes a list of items with keys 'io', 'data' and 'case' (see publisher), setting the client
+        credentials once. Returns the items published
         """
         try:
             self.reconfig()
+        except Exception as e:
+            logger.alert("Mqtt - Failed to publish {} items, ex {}".format(len(items), e))
+            return []
+
+        published = []
+        for item in items:
+            try:
+                if self.publish(item["io"], item.get("data"), item.get("case")):
+                    published.append(item)
+            except Exception as e:
+                logger.alert("Mqtt - Failed to publish , ex {}".format(e))
+        return published
 
-            payload = dict()
-            payload["io"] = io
+    def publish(self, io, data, case):
+        payload = dict()
+        payload["io"] = io
 
-            if data != None:
-                payload["data"] = data
+        if data != None:
+            payload["data"] = data
 
+        if logger.is_enabled('DEBUG'):
             logger.debug(
                 "Mqtt - Case {} and settings.api_version={} payload={}".format(case, settings.api_version, payload))
-            
-            if all(key in case for key in ("device_id", "component", "property")) or all(key in case for key in ("channel_id", "component", "property")):
 
-                channel_id = case["channel_id"] if "channel_id" in case else self.db.get_channel_id(case["device_id"])
+        if all(key in case for key in ("device_id", "component", "property")) or all(key in case for key in ("channel_id", "component", "property")):
 
-                if channel_id is None:
-                    logger.warning("Mqtt - No channel id found for this device")
-                    return
+            channel_id = case["channel_id"] if "channel_id" in case else self.db.get_channel_id(case["device_id"])
 
-                topic = "/{api_version}/channels/{channel_id}/components/{component}/properties/{property}/value".format(
-                    api_version=settings.api_version,
-                    channel_id=channel_id,
-                    component=case["component"],
-                    property=case["property"]
-                )
-            else:
+            if channel_id is None:
+                logger.warning("Mqtt - No channel id found for this device")
+                return False
 
-                logger.warning("Mqtt - Invalid arguments provided to publisher.")
-                raise Exception
+            topic = property_topic(channel_id, case["component"], case["property"])
+        else:
 
-            (rc, mid) = self.mqtt_client.publish(
-                topic=topic, payload=json.dumps(payload))
+            logger.warning("Mqtt - Invalid arguments provided to publisher.")
+            raise Exception
 
-            if rc == 0:
-                logger.info(
-                    "Mqtt - Published successfully, result code({}) and mid({}) to topic: {} with payload:{}".format(
-                        rc, mid, topic, format_str(payload, is_json=True)))
+        encoded = json_dumps(payload)
+        n, mqtt_client = self.get_client(channel_id)
+        (rc, mid) = mqtt_client.publish(topic=topic, payload=encoded, qos=PUBLISH_QOS)
 
-            else:
+        if rc == 0:
+            self.publish_tracker.published(n, mid)
+        with self._counters_lock:
+            self._counters[n]['published' if rc == 0 else 'failed'] += 1
 
-                raise Exception(
-                    "Mqtt - Failed to publish , result code({})".format(rc))
+        if rc == 0:
+            if logger.is_enabled('INFO'):
+                logger.info(
+                    "Mqtt - Published successfully, result code({}) and mid({}) to topic: {} with payload:{}".format(
+                        rc, mid, topic, encoded))
+            return True
 
-        except Exception as e:
-            logger.alert("Mqtt - Failed to publish , ex {}".format(e))
+        raise Exception(
+            "Mqtt - Failed to publish , result code({})".format(rc))
 
     def mqtt_decongif(self):
         try:
-            self.mqtt_client.unsubscribe("/{api_version}/managers/{client_id}/channels/#".format(
-                api_version=settings.api_version, client_id=settings.client_id))
-            self.mqtt_client.loop_stop()
-            self.mqtt_client.disconnect()
-            self.mqtt_client.disable_logger()
+            for n, mqtt_client in enumerate(self.mqtt_clients):
+                if self.subscribes(n):
+                    mqtt_client.unsubscribe(self.subscription_topic)
+                mqtt_client.loop_stop()
+                mqtt_client.disconnect()
+                mqtt_client.disable_logger()
         except Exception:
             logger.error("Mqtt - Failed to de-configure connection {}".format(traceback.format_exc(limit=5)))
             os._exit(1)
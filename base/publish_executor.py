@@ -0,0 +1,278 @@
+import time
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+from collections import OrderedDict
+from multiprocessing.queues import Queue
+
+from base import settings, logger
+from base.constants import DEFAULT_PUBLISH_WORKERS, DEFAULT_PUBLISH_HIGH_WATER_MARK, DEFAULT_PUBLISH_BATCH_SIZE, \
+    DEFAULT_PUBLISH_METRICS_INTERVAL, DEFAULT_PUBLISH_COALESCE_WINDOW, DEFAULT_PUBLISH_LAST_VALUES_SIZE
+
+PUBLISH_WORKERS = max(int(settings.config_mqtt.get('publish_workers', DEFAULT_PUBLISH_WORKERS)), 1)
+PUBLISH_HIGH_WATER_MARK = max(int(settings.config_mqtt.get('publish_high_water_mark',
+                                                           DEFAULT_PUBLISH_HIGH_WATER_MARK)), 0)
+PUBLISH_BATCH_SIZE = max(int(settings.config_mqtt.get('publish_batch_size', DEFAULT_PUBLISH_BATCH_SIZE)), 1)
+PUBLISH_METRICS_INTERVAL = settings.config_mqtt.get('publish_metrics_interval', DEFAULT_PUBLISH_METRICS_INTERVAL)
+PUBLISH_COALESCE_WINDOW = settings.config_mqtt.get('publish_coalesce_window', DEFAULT_PUBLISH_COALESCE_WINDOW)
+PUBLISH_DROP_UNCHANGED = settings.config_mqtt.get('publish_drop_unchanged', False)
+PUBLISH_LAST_VALUES_SIZE = settings.config_mqtt.get('publish_last_values_size', DEFAULT_PUBLISH_LAST_VALUES_SIZE)
+
+
+class PublishQueue(Queue):
+    """
+    Queue of mqtt publishes ({'io': ..., 'data': ..., 'case': ...}) shared by all processes of the manager.
+    Holds up to high_water_mark publishes (unbounded if 0): producers block while it's full, until the publish
+    workers catch up. Publishes are stamped with their enqueue time, to measure their latency.
+    """
+
+    def __init__(self, high_water_mark=PUBLISH_HIGH_WATER_MARK):
+        super().__init__(high_water_mark, ctx=mp.get_context())
+
+    def put(self, obj, block=True, timeout=None):
+        obj = dict(obj, enqueued_at=time.time())
+        try:
+            super().put(obj, block=False)
+        except queue.Full:
+            if not block:
+                raise
+            logger.warning(f"[Publisher] High-water mark reached ({self._maxsize} publishes), waiting")
+            super().put(obj, True, timeout)
+
+    def depth(self):
+        try:
+            return self.qsize()
+        except NotImplementedError:  # not available on macOS
+            return None
+
+
+class PublishCoalescer:
+    """
+    Keeps the latest publish of each case (io, channel or device, component and property) added until flushed.
+    If drop_unchanged, 'iw' publishes with the same data as the last one published for their case are dropped
+    ('ir' ones answer read requests, they're always published). The last values of up to last_values_size cases
+    are kept, recorded once published (see published).
+    """
+
+    def __init__(self, window, drop_unchanged=False, last_values_size=PUBLISH_LAST_VALUES_SIZE):
+        self.window = window
+        self.drop_unchanged = drop_unchanged
+        self.last_values_size = last_values_size
+        self.coalesced = 0
+        self.unchanged = 0
+        self._pending = {}  # case key: latest publish, in order of the first publish of the case
+        self._unkeyed = []
+        self._last_values = OrderedDict()
+        self._last_values_lock = threading.Lock()  # recorded by the publish workers
+
+    @staticmethod
+    def case_key(item):
+        case = item.get('case') or {}
+        target = case.get('channel_id') or case.get('device_id')
+        if target is None or 'component' not in case or 'property' not in case:
+            return None
+        return item['io'], target, case['component'], case['property']
+
+    def add(self, item):
+        key = self.case_key(item)
+        if key is None:
+            self._unkeyed.append(item)
+            return
+        if key in self._pending:
+            self.coalesced += 1
+            # keeps the first enqueue time, for the latency of the value the case waited for
+            item['enqueued_at'] = self._pending[key].get('enqueued_at', item.get('enqueued_at'))
+        self._pending[key] = item
+
+    def unchanged_value(self, key, item):
+        if item['io'] != 'iw':
+            return False
+        with self._last_values_lock:
+            if key in self._last_values and self._last_values[key] == item.get('data'):
+                self._last_values.move_to_end(key)
+                return True
+        return False
+
+    def published(self, items):
+        """ Records the data of published items, as the last value of their case """
+        if not self.drop_unchanged:
+            return
+        with self._last_values_lock:
+            for item in items:
+                key = self.case_key(item)
+                if key is None:
+                    continue
+                self._last_values[key] = item.get('data')
+                self._last_values.move_to_end(key)
+            while len(self._last_values) > self.last_values_size:
+                self._last_values.popitem(last=False)
+
+    def flush(self):
+        """ Returns the publishes added since last flush, coalesced """
+        items = self._unkeyed
+        for key, item in self._pending.items():
+            if self.drop_unchanged and self.unchanged_value(key, item):
+                self.unchanged += 1
+            else:
+                items.append(item)
+        self._pending = {}
+        self._unkeyed = []
+        return items
+
+
+class PublishExecutor:
+    """
+    Fixed pool of threads publishing the items of a publish queue.
+
+    A dispatcher thread hands the publishes waiting in the queue to the workers, each one publishing up to
+    batch_size of them at once with publish_batch(items), which returns the items published. The
+    publishes of a case (see PublishCoalescer.case_key) always go to the same worker, so they're published in
+    order. While the worker of a publish is busy the dispatcher stops reading, so the queue fills up to its
+    high-water mark.
+    With a coalesce_window, the dispatcher collects the publishes received during coalesce_window seconds and
+    only hands the latest one of each case to the workers (see PublishCoalescer).
+    :param connection_metrics: optional function returning the metrics of the mqtt connections, logged with
+    the publish metrics
+    """
+
+    def __init__(self, publish_batch, publish_queue, workers=PUBLISH_WORKERS, batch_size=PUBLISH_BATCH_SIZE,
+                 metrics_interval=PUBLISH_METRICS_INTERVAL, connection_metrics=None,
+                 coalesce_window=PUBLISH_COALESCE_WINDOW, drop_unchanged=PUBLISH_DROP_UNCHANGED):
+        self.publish_batch = publish_batch
+        self.coalescer = PublishCoalescer(coalesce_window, drop_unchanged) \
+            if coalesce_window or drop_unchanged else None
+        self.connection_metrics = connection_metrics
+        self.queue = publish_queue
+        self.workers = workers
+        self.batch_size = batch_size
+        self.metrics_interval = metrics_interval
+        self._pending = [queue.Queue(maxsize=batch_size * 2) for _ in range(workers)]  # publishes of each worker
+        self._next_worker = 0  # for publishes without case, handed to workers in turn
+        self._lock = threading.Lock()
+        self._counters = {
+            'published': 0,
+            'failed': 0,
+            'batches': 0,
+            'max_depth': 0,
+            'latency': 0.0,
+            'max_latency': 0.0,
+            'publish_time': 0.0
+        }
+
+    def start(self):
+        logger.notice(f"[Publisher] Starting {self.workers} workers, batch size {self.batch_size}")
+        threading.Thread(target=self.dispatch, name='Publish', daemon=True).start()
+        for n in range(self.workers):
+            threading.Thread(target=self.run, args=[n], name=f"Publish-{n}", daemon=True).start()
+        if self.metrics_interval:
+            threading.Thread(target=self.log_metrics, name='Publish-metrics', daemon=True).start()
+
+    def get_batch(self):
+        """ Returns the publishes waiting in queue, up to a batch for each worker """
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size * self.workers:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def get_coalesced(self):
+        """ Returns the publishes received during the coalesce window following the next one, coalesced """
+        if not self.coalescer.window:
+            for item in self.get_batch():
+                self.coalescer.add(item)
+            return self.coalescer.flush()
+
+        self.coalescer.add(self.queue.get())
+        deadline = time.monotonic() + self.coalescer.window
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self.coalescer.add(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return self.coalescer.flush()
+
+    def dispatch(self):
+        while True:
+            try:
+                items = self.get_coalesced() if self.coalescer else self.get_batch()
+                depth = self.queue.depth()
+                if depth is not None:
+                    with self._lock:
+                        self._counters['max_depth'] = max(self._counters['max_depth'], depth + len(items))
+                for item in items:
+                    self._pending[self.worker_of(item)].put(item)
+            except Exception:
+                logger.error(f"[Publisher] Unexpected error dispatching: {traceback.format_exc(limit=5)}")
+
+    def worker_of(self, item):
+        key = PublishCoalescer.case_key(item)
+        if key is None:
+            self._next_worker = (self._next_worker + 1) % self.workers
+            return self._next_worker
+        return hash(key) % self.workers
+
+    def run(self, worker):
+        pending = self._pending[worker]
+        while True:
+            batch = [pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.publish(batch)
+            except Exception:
+                logger.error(f"[Publisher] Unexpected error publishing: {traceback.format_exc(limit=5)}")
+
+    def publish(self, batch):
+        start = time.time()
+        enqueued = [item.pop('enqueued_at', start) for item in batch]
+        published = self.publish_batch(batch)
+        end = time.time()
+        if self.coalescer:
+            self.coalescer.published(published)
+
+        with self._lock:
+            counters = self._counters
+            counters['published'] += len(published)
+            counters['failed'] += len(batch) - len(published)
+            counters['batches'] += 1
+            counters['publish_time'] += end - start
+            counters['latency'] += sum(end - enqueued_at for enqueued_at in enqueued)
+            counters['max_latency'] = max(counters['max_latency'], end - min(enqueued))
+
+    def metrics(self):
+        """
+        Returns the publishes waiting in queue (depth, None if unknown), published and failed counters, the
+        average time from enqueue to publish (avg_latency) and of each publish_batch call (avg_publish_time),
+        and the publishes replaced by a later one of their case (coalesced) or dropped as unchanged
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        total = counters['published'] + counters['failed']
+        return {
+            'depth': self.queue.depth(),
+            'max_depth': counters['max_depth'],
+            'published': counters['published'],
+            'failed': counters['failed'],
+            'batches': counters['batches'],
+            'avg_latency': counters['latency'] / total if total else 0.0,
+            'max_latency': counters['max_latency'],
+            'avg_publish_time': counters['publish_time'] / counters['batches'] if counters['batches'] else 0.0,
+            'coalesced': self.coalescer.coalesced if self.coalescer else 0,
+            'unchanged': self.coalescer.unchanged if self.coalescer else 0
+        }
+
+    def log_metrics(self):
+        while True:
+            time.sleep(self.metrics_interval)
+            logger.info(f"[Publisher] Metrics: {self.metrics()}")
+            if self.connection_metrics:
+                logger.info(f"[Publisher] Mqtt metrics: {self.connection_metrics()}")
@@ -0,0 +1,93 @@
+import time
+import threading
+from collections import deque
+
+from base import settings
+from base.constants import DEFAULT_PUBLISH_ACK_WINDOW, DEFAULT_PUBLISH_ACK_TIMEOUT
+
+ACK_WINDOW = settings.config_mqtt.get('ack_window', DEFAULT_PUBLISH_ACK_WINDOW)
+ACK_TIMEOUT = settings.config_mqtt.get('ack_timeout', DEFAULT_PUBLISH_ACK_TIMEOUT)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+class PublishTracker:
+    """
+    Matches mqtt publishes, by connection and mid, to their acknowledgement (on_publish: once written to the
+    socket with qos 0, on PUBACK with qos 1 and PUBCOMP with qos 2), to measure the publish to ack latency over
+    the last window acks. Publishes not acknowledged within ack_timeout seconds are counted as expired, checked
+    at most every ack_timeout seconds as publishes and acks are tracked.
+    """
+
+    def __init__(self, window=ACK_WINDOW, ack_timeout=ACK_TIMEOUT):
+        self.ack_timeout = ack_timeout
+        self._pending = {}  # (connection, mid): publish time
+        self._early = {}  # (connection, mid): ack time, for acks received before their publish returned
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._acked = 0
+        self._expired = 0
+        self._next_expire = time.time() + ack_timeout
+
+    def published(self, connection, mid, at=None):
+        at = time.time() if at is None else at
+        self._expire_if_due(at)
+        with self._lock:
+            acked_at = self._early.pop((connection, mid), None)
+            if acked_at is None:
+                self._pending[(connection, mid)] = at
+            else:
+                self._ack(max(acked_at - at, 0.0))
+
+    def acknowledged(self, connection, mid, at=None):
+        at = time.time() if at is None else at
+        self._expire_if_due(at)
+        with self._lock:
+            published_at = self._pending.pop((connection, mid), None)
+            if published_at is None:
+                self._early[(connection, mid)] = at
+            else:
+                self._ack(at - published_at)
+
+    def _ack(self, latency):
+        self._acked += 1
+        self._latencies.append(latency)
+
+    def _expire_if_due(self, now):
+        # unlocked check: at worst two threads expire at once
+        if now >= self._next_expire:
+            self.expire(now)
+
+    def expire(self, now=None):
+        """ Drops publishes waiting for their ack (and acks for their publish) for longer than ack_timeout """
+        now = time.time() if now is None else now
+        limit = now - self.ack_timeout
+        with self._lock:
+            self._next_expire = now + self.ack_timeout
+            expired = [key for key, published_at in self._pending.items() if published_at < limit]
+            for key in expired:
+                del self._pending[key]
+            self._expired += len(expired)
+            for key in [key for key, acked_at in self._early.items() if acked_at < limit]:
+                del self._early[key]
+
+    def metrics(self):
+        """
+        Returns the publishes waiting for their ack (in_flight), acked and expired counters, and publish to ack
+        latency percentiles of the last window acks
+        """
+        self.expire()
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = {'in_flight': len(self._pending), 'acked': self._acked, 'expired': self._expired}
+        metrics.update({
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p90': percentile(latencies, 0.9),
+            'latency_p99': percentile(latencies, 0.99),
+            'latency_max': latencies[-1] if latencies else 0.0
+        })
+        return metrics
@@ -2,8 +2,10 @@ try:
     import uwsgi
 except ModuleNotFoundError:
     pass
+import os
 import json
 import re
+import queue
 import logging.handlers
 import time
 from functools import wraps
@@ -60,23 +62,34 @@ def update_log_level(func):
     return update_level
 
 
+def escape_message(message) -> str:
+    """ Masks tokens and escapes message, to be written in the json log format """
+    token_regex = r"[\'\"](refresh_token|access_token|token)[\'\"].{2}[\'\"]([^\'\"]*)"
+    if not type(message) is str:
+        message = json.dumps(message)
+    token_match = re.findall(token_regex, message)
+    for match_ in token_match:
+        if len(match_) == 2:
+            token = match_[1]
+            num_chars = int(len(token)/10)
+            message = message.replace(token, f"{token[0:num_chars]}...{token[-num_chars:]}")
+    message = message.replace('\n', '\\n')
+    message = message.replace('\t', '\\t')
+    message = message.replace('"', '\\"')
+    message = message.replace("'", "\\'")
+    return message
+
+
 def format_message(func):
+    level = log_levels[func.__name__.upper()][1]
+
     @wraps(func)
     def message_replace(self, message, *args, **kwargs) -> func:
-        token_regex = r"[\'\"](refresh_token|access_token|token)[\'\"].{2}[\'\"]([^\'\"]*)"
-        if hasattr(self, 'log_type') and self.log_type == 'json':
-            if not type(message) is str:
-                message = json.dumps(message)
-            token_match = re.findall(token_regex, message)
-            for match_ in token_match:
-                if len(match_) == 2:
-                    token = match_[1]
-                    num_chars = int(len(token)/10)
-                    message = message.replace(token, f"{token[0:num_chars]}...{token[-num_chars:]}")
-            message = message.replace('\n', '\\n')
-            message = message.replace('\t', '\\t')
-            message = message.replace('"', '\\"')
-            message = message.replace("'", "\\'")
+        if not self.isEnabledFor(level):
+            return None
+        # in queue mode, messages are escaped by the listener thread (see EscapeFilter)
+        if hasattr(self, 'log_type') and self.log_type == 'json' and not getattr(self, 'queued', False):
+            message = escape_message(message)
         return func(self, message, *args, **kwargs)
 
     return message_replace
@@ -203,6 +216,12 @@ def emergency(self, message, *args, **kws) -> None:
         self._log(log_levels["EMERGENCY"][1], message, args, **kws)
 
 
+@update_log_level
+def is_enabled(self, level_name) -> bool:
+    """ Whether messages of level_name (e.g. 'DEBUG') are logged, to skip building messages that are not """
+    return self.isEnabledFor(log_levels[level_name.upper()][1])
+
+
 def setup_logger_handler(log_path, log_level, log_type, host_pub) -> logging.handlers:
     # Create the Handler for logging data to a file
     if log_path == "/var/log/syslog":
@@ -239,6 +258,112 @@ def setup_logger_handler(log_path, log_level, log_type, host_pub) -> logging.han
     return logger_handler
 
 
+class EscapeFilter(logging.Filter):
+    """ Escapes the messages of records for the json log format, on the thread handling them """
+
+    def filter(self, record) -> bool:
+        record.msg = escape_message(record.msg)
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records to be formatted and written by a QueueListener thread. When the queue is full, the record
+    is dropped (drop_new), replaces the oldest one waiting (drop_old) or the logging thread waits (block).
+    Dropped records are reported by the listener (see BoundedQueueListener).
+    """
+
+    def __init__(self, record_queue, overflow) -> None:
+        super().__init__(record_queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record) -> logging.LogRecord:
+        # records stay in process, formatting is left to the listener thread
+        return record
+
+    def put(self, record) -> bool:
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return True
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            if self.overflow != 'drop_old':
+                return False
+        try:
+            self.queue.get_nowait()
+            self.dropped += 1
+            self._unreported += 1
+        except queue.Empty:
+            pass
+        return self.put(record)
+
+    def enqueue(self, record) -> None:
+        if not self.put(record):
+            self.dropped += 1
+            self._unreported += 1
+
+    def take_unreported(self) -> int:
+        unreported = self._unreported
+        self._unreported -= unreported
+        return unreported
+
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+    """ QueueListener reporting the records dropped by queue_handler before writing the next one """
+
+    def __init__(self, queue_handler, *handlers) -> None:
+        super().__init__(queue_handler.queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+
+    def handle(self, record) -> None:
+        dropped = self.queue_handler.take_unreported()
+        if dropped:
+            super().handle(logging.makeLogRecord({
+                'name': record.name, 'levelno': log_levels["WARNING"][1],
+                'levelname': logging.getLevelName(log_levels["WARNING"][1]),
+                'msg': f"{dropped} log records dropped, log queue full",
+                'zptLogLevel': 109 - log_levels["WARNING"][1]
+            }))
+        super().handle(record)
+
+    def enqueue_sentinel(self) -> None:
+        # on stop the queue may be full, the listener thread makes room
+        self.queue.put(self._sentinel)
+
+
+def setup_queue_handler(logger_handler, queue_size, overflow, escape) -> tuple:
+    """
+    Returns a handler queuing records and the listener writing them with logger_handler, restarted in forked
+    processes (e.g. uWSGI workers, mqtt subscriber processes)
+    :param escape: if True, messages are escaped for the json log format by the listener
+    """
+    if escape:
+        logger_handler.addFilter(EscapeFilter())
+    queue_handler = BoundedQueueHandler(queue.Queue(maxsize=queue_size), overflow)
+    listener = BoundedQueueListener(queue_handler, logger_handler)
+
+    def before_fork():
+        # waits for the record being written and flushes, so the child doesn't inherit a busy stream
+        logger_handler.acquire()
+        logger_handler.flush()
+
+    def restart_in_child():
+        # the listener thread doesn't survive fork, records left in queue are written by the parent
+        queue_handler.queue = queue.Queue(maxsize=queue_size)
+        listener.queue = queue_handler.queue
+        listener._thread = None
+        listener.start()
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(before=before_fork, after_in_parent=logger_handler.release,
+                            after_in_child=restart_in_child)
+    return queue_handler, listener
+
+
 def setup_loglevel() -> None:
     for lvl in log_levels.keys():
         logging.addLevelName(log_levels[lvl][0], log_levels[lvl][1])
@@ -253,3 +378,4 @@ def setup_loglevel() -> None:
     logging.Logger.critical = critical
     logging.Logger.alert = alert
     logging.Logger.emergency = emergency
+    logging.Logger.is_enabled = is_enabled
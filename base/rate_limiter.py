@@ -0,0 +1,120 @@
+import time
+import asyncio
+import threading
+import traceback
+from functools import wraps
+
+from base import settings, logger
+
+# Reserves one token of the bucket stored in hash KEYS[1]; ARGV: rate (tokens/second), capacity, now (seconds).
+# Returns the seconds to wait before using the token, as a string (lua numbers are truncated to integers)
+RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or capacity)
+local last = tonumber(redis.call('HGET', KEYS[1], 'last') or now)
+if last > now then
+    now = last
+end
+tokens = math.min(capacity, tokens + (now - last) * rate) - 1
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for one process: rate tokens per second are added up to capacity (the burst).
+    Only the token reservation is serialized, callers then wait for their turn concurrently.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Takes one token, returns the seconds to wait before using it """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate) - 1
+            self._last = now
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    Token bucket shared by every thread and process (e.g. uWSGI workers) using the same redis hash and name.
+    Falls back to the local bucket while redis is unavailable.
+    """
+
+    def __init__(self, name, rate, capacity=1):
+        super().__init__(rate, capacity)
+        self.name = name
+        self.key = f"{settings.redis_db}/rate-limits/{name}"
+        self._script = None
+
+    def reserve(self):
+        try:
+            if self._script is None:
+                from base.redis_db import get_redis
+                self._script = get_redis().register_script(RESERVE_SCRIPT)
+            return float(self._script(keys=[self.key], args=[self.rate, self.capacity, time.time()]))
+        except Exception:
+            logger.error(f"[RateLimiter] {self.name}: shared bucket unavailable, limiting locally: "
+                         f"{traceback.format_exc(limit=5)}")
+            return super().reserve()
+
+    async def acquire_async(self):
+        # the reservation is a redis round trip, made out of the event loop
+        wait = await asyncio.get_event_loop().run_in_executor(None, self.reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def get_bucket(max_per_second, burst=1, shared_key=None):
+    """
+    :param shared_key: name of a limit shared through redis with other processes, local to the process if None
+    """
+    return RedisTokenBucket(shared_key, max_per_second, burst) if shared_key else TokenBucket(max_per_second, burst)
+
+
+def rate_limited(max_per_second, burst=1, max_concurrency=None, shared_key=None):
+    """
+    Rate-limits the decorated function to max_per_second calls, allowing bursts of up to burst calls.
+    :param max_concurrency: max calls running at the same time, unlimited if None
+    :param shared_key: name of a limit shared through redis with other processes, local to the process if None
+    """
+    bucket = get_bucket(max_per_second, burst, shared_key)
+    semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def decorate(func):
+        @wraps(func)
+        def rate_limited_function(*args, **kwargs):
+            if semaphore is None:
+                bucket.acquire()
+                return func(*args, **kwargs)
+            with semaphore:
+                bucket.acquire()
+                return func(*args, **kwargs)
+
+        return rate_limited_function
+
+    return decorate
@@ -1,15 +1,332 @@
 import ast
 import json
+import hashlib
 import traceback
 import re
+import time
+import uuid
 from datetime import datetime
 
 from redis import Redis
 from base import settings, logger
+from base.lookup_cache import LookupCache, CLEAR_ALL
+from base.redis_pool import get_connection_pool
+from base.constants import DEFAULT_CACHE_MAX_SIZE, DEFAULT_CACHE_TTL, DEFAULT_SCAN_BATCH_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+INDEXED = settings.config_redis.get('indexed', False)
+SCAN_BATCH_SIZE = settings.config_redis.get('scan_batch_size', DEFAULT_SCAN_BATCH_SIZE)
+INDEX_VERSION = 1
+INDEX_BUILD_LOCK = 'credential-indexes'
+INDEX_BUILD_LOCK_TIMEOUT = 600  # seconds, a build taking longer may run again in another process
+
+# Key layouts kept in secondary indexes (None marks a variable segment). For every stored field matching
+# a layout, a set is kept for each combination of its variable segments replaced by '*', so that
+# e.g. credential-owners/*/channels/<channel_id> is served without scanning the whole hash.
+INDEX_LAYOUTS = (
+    ('credential-owners', None, 'channels', None),
+    ('credential-clients', None, 'owners', None),
+    ('device-channels', None),
+    ('channel-devices', None),
+)
+
+GLOB_REGEX = re.compile(r'[*?\[\\]')
+
+# Values are stored with a version/type tag so they are decoded once by the right decoder:
+# $v1j:<json>, $v1s:<plain string>, $v1p:<python literal, for values json can't encode>.
+# Untagged values were written by previous versions (json dicts, python repr of lists, plain strings).
+VALUE_ENCODING = settings.config_redis.get('value_encoding', 'v1')
+VALUE_TAG = '$v1'
+JSON_TAG = VALUE_TAG + 'j:'
+STR_TAG = VALUE_TAG + 's:'
+LITERAL_TAG = VALUE_TAG + 'p:'
+TAG_LENGTH = len(JSON_TAG)
+LEGACY_LITERAL_START = ('[', '{', '(', "'", '"')
+LEGACY_LITERAL_WORDS = ('True', 'False', 'None')
+
+
+# Deletes lock KEYS[1] only if still held by ARGV[1] (the token of its holder, it may have expired meanwhile)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Moves the refresh tokens index hash built in KEYS[1] into place (KEYS[2]), keeping the entries stored meanwhile
+# by set_credentials, and marks the index ready (KEYS[3])
+REPLACE_REFRESH_TOKEN_KEYS_SCRIPT = """
+local entries = redis.call('HGETALL', KEYS[2])
+for i = 1, #entries, 2 do
+    redis.call('HSET', KEYS[1], entries[i], entries[i + 1])
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+redis.call('SET', KEYS[3], 1)
+return 1
+"""
+
+# Removes members ARGV[2..] of index KEYS[1], a set or sorted set (ARGV[1] being SREM or ZREM), whose field is not in
+# hash KEYS[2]: fields stored again since they were read missing are kept. Returns the number of members removed
+REMOVE_MISSING_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    if redis.call('HEXISTS', KEYS[2], ARGV[i]) == 0 then
+        removed = removed + redis.call(ARGV[1], KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# Removes channel credentials ARGV[2..] from the set of refresh token digest ARGV[1] (KEYS[1]), unless hash KEYS[2]
+# still has that digest for them: stored again with that refresh token since they were read.
+# Returns the number of members removed
+REMOVE_STALE_REFRESH_TOKEN_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    if redis.call('HGET', KEYS[2], ARGV[i]) ~= ARGV[1] then
+        removed = removed + redis.call('SREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# Keys read on every mqtt message, cached in process when enabled
+CACHE_CONF = settings.config_redis.get('cache', {})
+CACHED_PREFIXES = ('device-channels/', 'channel-devices/', 'credential-owners/', 'credential-clients/')
+INVALIDATION_CHANNEL = "{}/invalidations".format(settings.redis_db)
+
+
+def is_cached(key):
+    return lookup_cache is not None and key.startswith(CACHED_PREFIXES)
+
+
+def json_dumps(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except TypeError:  # e.g. non str dict keys, that json converts
+            pass
+    return json.dumps(value)
+
+
+def json_loads(value):
+    return orjson.loads(value) if orjson is not None else json.loads(value)
+
+
+def encode_value(value):
+    if VALUE_ENCODING == 'legacy':
+        return json.dumps(value) if type(value) is dict else value
+    if type(value) is str:
+        return STR_TAG + value
+    try:
+        return JSON_TAG + json_dumps(value)
+    except (TypeError, ValueError):
+        return LITERAL_TAG + repr(value)
+
+
+def decode_value(value):
+    if value is None:
+        return None
+    if value.startswith(VALUE_TAG):
+        tag, payload = value[:TAG_LENGTH], value[TAG_LENGTH:]
+        if tag == JSON_TAG:
+            return json_loads(payload)
+        if tag == STR_TAG:
+            return payload
+        if tag == LITERAL_TAG:
+            return ast.literal_eval(payload)
+    return decode_legacy_value(value)
+
+
+def decode_legacy_value(value):
+    # as previous versions read them: numbers and json first, then python literals (e.g. repr of lists, True)
+    try:
+        return json_loads(value)
+    except ValueError:
+        pass
+    if value.startswith(LEGACY_LITERAL_START) or value in LEGACY_LITERAL_WORDS:
+        try:
+            return ast.literal_eval(value)
+        except Exception:
+            pass
+    return value
+
+
+def is_channel_credentials(key):
+    return key.startswith('credential-owners/') and '/channels/' in key
+
+
+def expiration_score(credentials):
+    """ Score of channel credentials in the expirations index: their expiration_date, 0 if unknown (due) """
+    try:
+        return float(credentials.get('expiration_date') or 0)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def refresh_token_of(credentials):
+    try:
+        return credentials.get('refresh_token') or credentials.get('data', {}).get('refresh_token')
+    except AttributeError:
+        return None
+
+
+def refresh_token_digest(refresh_token):
+    """ Refresh tokens are indexed by digest, raw tokens are never used as key names """
+    return hashlib.sha256(str(refresh_token).encode()).hexdigest()
+
+
+def index_patterns(key):
+    """
+    Returns the index names (glob patterns) a hash field belongs to, if its key follows one of INDEX_LAYOUTS
+    """
+    for layout in INDEX_LAYOUTS:
+        parts = key.split('/', len(layout) - 1)
+        if len(parts) != len(layout) or \
+                any(literal is not None and literal != part for literal, part in zip(layout, parts)):
+            continue
+
+        variables = [i for i, literal in enumerate(layout) if literal is None]
+        patterns = []
+        for mask in range(1, 2 ** len(variables)):
+            pattern = list(parts)
+            for bit, position in enumerate(variables):
+                if mask & (1 << bit):
+                    pattern[position] = '*'
+            patterns.append('/'.join(pattern))
+        return patterns
+    return []
 
 
 class DBManager(Redis):
 
+    def _hget(self, key):
+        """ HGET of a field of the hash, served by the in-process cache for cached keys """
+        if not is_cached(key):
+            return self.hget(settings.redis_db, key)
+
+        found, value = lookup_cache.get(key)
+        if not found:
+            version = lookup_cache.version
+            value = self.hget(settings.redis_db, key)
+            lookup_cache.set(key, value, version)
+        return value
+
+    def _invalidate(self, pipe, key):
+        if is_cached(key):
+            lookup_cache.invalidate(key)
+            pipe.publish(INVALIDATION_CHANNEL, key)
+
+    def cache_stats(self):
+        return lookup_cache.stats() if lookup_cache is not None else {}
+
+    @property
+    def index_prefix(self):
+        return "{}/index/".format(settings.redis_db)
+
+    @property
+    def index_version_key(self):
+        return "{}/index-version".format(settings.redis_db)
+
+    @property
+    def index_enabled_key(self):
+        """ Time of the first write of a manager in indexed mode """
+        return "{}/index-enabled".format(settings.redis_db)
+
+    @property
+    def expirations_key(self):
+        return "{}/credential-expirations".format(settings.redis_db)
+
+    @property
+    def expirations_ready_key(self):
+        return "{}/credential-expirations-ready".format(settings.redis_db)
+
+    @property
+    def refresh_tokens_prefix(self):
+        return "{}/refresh-tokens/".format(settings.redis_db)
+
+    @property
+    def refresh_token_keys_key(self):
+        return "{}/refresh-token-keys".format(settings.redis_db)
+
+    @property
+    def refresh_tokens_ready_key(self):
+        return "{}/refresh-tokens-ready".format(settings.redis_db)
+
+    def _index_refresh_token(self, pipe, key, refresh_token, previous_digest):
+        """
+        Adds channel credentials to the set of their refresh token digest, and removes them from the set of
+        their previous one (kept in refresh_token_keys_key)
+        """
+        digest = refresh_token_digest(refresh_token) if refresh_token else None
+        if previous_digest and previous_digest != digest:
+            pipe.srem(self.refresh_tokens_prefix + previous_digest, key)
+        if digest:
+            pipe.sadd(self.refresh_tokens_prefix + digest, key)
+            pipe.hset(self.refresh_token_keys_key, key, digest)
+        elif previous_digest:
+            pipe.hdel(self.refresh_token_keys_key, key)
+
+    def index_ready(self):
+        """ Indexes are only used to serve queries after being built by build_indexes """
+        if not INDEXED:
+            return False
+        if not getattr(self, '_index_ready', False):
+            try:
+                self._index_ready = int(self.get(self.index_version_key) or 0) >= INDEX_VERSION
+            except Exception:
+                logger.error("[DB] Failed to check index version. {}".format(traceback.format_exc(limit=5)))
+                return False
+            if not self._index_ready:
+                logger.warning("[DB] Indexed mode enabled but indexes were not built, falling back to hash scan")
+        return self._index_ready
+
+    def _iter_query(self, regex, batch_size=SCAN_BATCH_SIZE):
+        """
+        Yields (key, raw value) of all hash fields matching regex, served by a single HGET for exact keys,
+        by the secondary indexes if available or by a full hash scan otherwise.
+        Indexes and hash are read in batches of about batch_size fields (SSCAN/HSCAN COUNT)
+        """
+        if not GLOB_REGEX.search(regex):
+            value = self._hget(regex)
+            if value is not None:
+                yield regex, value
+            return
+
+        if regex in index_patterns(regex) and self.index_ready():
+            index_name = self.index_prefix + regex
+            keys = []
+            for key in self.sscan_iter(index_name, count=batch_size):
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    yield from self._iter_indexed(index_name, keys)
+                    keys = []
+            if keys:
+                yield from self._iter_indexed(index_name, keys)
+            return
+
+        yield from self.hscan_iter(settings.redis_db, match=regex, count=batch_size)
+
+    def _iter_indexed(self, index_name, keys):
+        stale = []
+        for key, value in zip(keys, self.hmget(settings.redis_db, keys)):
+            if value is None:
+                stale.append(key)
+            else:
+                yield key, value
+        if stale:
+            self.remove_missing(index_name, 'SREM', stale)
+
+    def remove_missing(self, index_name, command, keys):
+        """ Removes keys from an index (SREM for sets, ZREM for sorted sets), unless stored again meanwhile """
+        return self.register_script(REMOVE_MISSING_SCRIPT)(keys=[index_name, settings.redis_db], args=[command] + keys)
+
     def set_key(self, key, value):
         """
         To set a key-field in hash table
@@ -20,9 +337,7 @@ class DBManager(Redis):
 
         """
         try:
-            if type(value) is dict:
-                value = json.dumps(value)
-            self.hset(settings.redis_db, key, value)
+            self._set_keys({key: value})
 
             logger.debug("[DB] Key {} added/updated in database".format(key))
             return True
@@ -30,6 +345,66 @@ class DBManager(Redis):
             logger.error("[DB] Failed to set the key at hash. {}".format(traceback.format_exc(limit=5)))
             return False
 
+    def _set_keys(self, mapping):
+        credential_keys = [key for key in mapping if is_channel_credentials(key)]
+        previous_digests = dict(zip(credential_keys, self.hmget(self.refresh_token_keys_key, credential_keys))) \
+            if credential_keys else {}
+
+        pipe = self.pipeline()
+        pipe.hmset(settings.redis_db, {key: encode_value(value) for key, value in mapping.items()})
+        if INDEXED:
+            pipe.set(self.index_enabled_key, time.time(), nx=True)
+        for key, value in mapping.items():
+            if INDEXED:
+                for pattern in index_patterns(key):
+                    pipe.sadd(self.index_prefix + pattern, key)
+            if is_channel_credentials(key):
+                pipe.zadd(self.expirations_key, **{key: expiration_score(value)})
+                self._index_refresh_token(pipe, key, refresh_token_of(value), previous_digests.get(key))
+            self._invalidate(pipe, key)
+        pipe.execute()
+
+    def set_keys(self, mapping):
+        """
+        To set many key-fields in hash table in one round trip
+            mapping : dict of key: content of field
+        """
+        if not mapping:
+            return True
+        try:
+            self._set_keys(mapping)
+            logger.debug("[DB] {} keys added/updated in database".format(len(mapping)))
+            return True
+        except Exception:
+            logger.error("[DB] Failed to set keys at hash. {}".format(traceback.format_exc(limit=5)))
+            return False
+
+    def get_keys(self, keys):
+        """
+        To get many key's fields from hash table in one round trip. Returns a dict with the keys found
+        """
+        values = {}
+        try:
+            missing = []
+            for key in keys:
+                found, value = lookup_cache.get(key) if is_cached(key) else (False, None)
+                if found:
+                    values[key] = value
+                else:
+                    missing.append(key)
+
+            if missing:
+                version = lookup_cache.version if lookup_cache is not None else None
+                for key, value in zip(missing, self.hmget(settings.redis_db, missing)):
+                    if is_cached(key):
+                        lookup_cache.set(key, value, version)
+                    values[key] = value
+
+            return {key: decode_value(value) for key, value in values.items() if value is not None}
+        except Exception as e:
+            logger.error("[DB] get_keys error, {}".format(e))
+        return {}
+
     def has_key(self, key):
         try:
             result = self.hexists(settings.redis_db, key)
@@ -40,17 +415,10 @@ class DBManager(Redis):
     def get_key(self, key):
         """To get a key"s field from hash table"""
         try:
-            if self.hexists(settings.redis_db, key):
-                value = self.hget(settings.redis_db, key)
+            value = self._hget(key)
+            if value is not None:
                 logger.debug("[DB]  Key {} retrieved from database.".format(key))
-                try:
-                    evaluated_value = ast.literal_eval(value)
-                except Exception:
-                    try:
-                        evaluated_value = json.loads(value)
-                    except Exception:
-                        evaluated_value = value
-                return evaluated_value
+                return decode_value(value)
             else:
                 logger.info("[DB] Key {} not found in database.".format(key))
         except Exception as e:
@@ -58,7 +426,17 @@ class DBManager(Redis):
 
     def delete_key(self, key):
         try:
-            result = self.hdel(settings.redis_db, key)
+            previous_digest = self.hget(self.refresh_token_keys_key, key) if is_channel_credentials(key) else None
+            pipe = self.pipeline()
+            pipe.hdel(settings.redis_db, key)
+            if INDEXED:
+                for pattern in index_patterns(key):
+                    pipe.srem(self.index_prefix + pattern, key)
+            if is_channel_credentials(key):
+                pipe.zrem(self.expirations_key, key)
+                self._index_refresh_token(pipe, key, None, previous_digest)
+            self._invalidate(pipe, key)
+            result = pipe.execute()[0]
             return result == 1
         except Exception:
             logger.error("[DB] Failed to delete hash key. {}".format(traceback.format_exc(limit=5)))
@@ -89,17 +467,8 @@ class DBManager(Redis):
 
         results = []
         try:
-            for element in self.hscan_iter(settings.redis_db, match=regex):
-                str_element = element[1]
-                try:
-                    value = json.loads(str_element)
-                except Exception:
-                    try:
-                        value = ast.literal_eval(str_element)
-                    except Exception:
-                        value = str_element
-                    
-                results.append(value)
+            for element in self._iter_query(regex):
+                results.append(decode_value(element[1]))
 
             logger.debug("[DB] Query found {} results!".format(len(results)))
             return results
@@ -111,19 +480,10 @@ class DBManager(Redis):
 
         results = []
         try:
-            for element in self.hscan_iter(settings.redis_db, match=regex):
-                str_element = element[1]
-                try:
-                    value = json.loads(str_element)
-                except Exception:
-                    try:
-                        value = ast.literal_eval(str_element)
-                    except Exception:
-                        value = str_element
-
+            for element in self._iter_query(regex):
                 results.append({
                     'key': element[0],
-                    'value': value
+                    'value': decode_value(element[1])
                 })
 
             logger.debug("[DB] Full Query found {} results!".format(len(results)))
@@ -131,13 +491,273 @@ class DBManager(Redis):
         except Exception as e:
             logger.error("[DB] full query :: {}".format(e, traceback.format_exc(limit=5)))
 
+    def iter_full_query(self, regex, fields=None, batch_size=SCAN_BATCH_SIZE):
+        """
+        Streaming full_query: yields {'key': key, 'value': value} items while reading the hash in batches of
+        about batch_size fields, so memory doesn't grow with the number of results.
+            fields : if set, dict values are projected to these fields as soon as decoded
+        """
+        logger.debug("[DB] iter full query regex={}".format(regex))
+        n_results = 0
+        try:
+            for key, value in self._iter_query(regex, batch_size):
+                value = decode_value(value)
+                if fields is not None and isinstance(value, dict):
+                    value = {field: value[field] for field in fields if field in value}
+                n_results += 1
+                yield {
+                    'key': key,
+                    'value': value
+                }
+            logger.debug("[DB] Iter Full Query found {} results!".format(n_results))
+        except Exception as e:
+            logger.error("[DB] iter full query :: {}".format(e, traceback.format_exc(limit=5)))
+
     def clear_hash(self):
         try:
-            self.delete(settings.redis_db)
+            self.delete(settings.redis_db, self.expirations_key, self.expirations_ready_key)
+            self.drop_refresh_tokens()
+            self.drop_indexes()
+            if lookup_cache is not None:
+                lookup_cache.clear()
+                self.publish(INVALIDATION_CHANNEL, CLEAR_ALL)
             logger.notice("[DB] Redis database shutdown.")
         except Exception:
             logger.error("[DB] Failed to clear redis database, {}".format(traceback.format_exc(limit=5)))
 
+    def drop_indexes(self):
+        index_keys = list(self.scan_iter(match="{}*".format(self.index_prefix)))
+        index_keys.append(self.index_version_key)
+        self.delete(*index_keys)
+        self._index_ready = False
+
+    def _add_to_indexes(self, batch_size, prefix):
+        n_keys = 0
+        pipe = self.pipeline(transaction=False)
+        for key, _ in self.hscan_iter(settings.redis_db, count=batch_size):
+            patterns = index_patterns(key)
+            if not patterns:
+                continue
+            for pattern in patterns:
+                pipe.sadd(prefix + pattern, key)
+            n_keys += 1
+            if n_keys % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+        return n_keys
+
+    def build_indexes(self, batch_size=1000):
+        """
+        Migration of an existing hash to indexed mode: (re)builds every secondary index from the hash fields.
+        Indexed mode must be enabled on the managers first: the indexes are only marked ready if managers were
+        already writing in indexed mode when the build started, otherwise fields they store meanwhile could be
+        missing. A second pass over the hash adds the fields stored during the first one.
+        The indexes are built in temporary keys then renamed into place, keeping the fields stored meanwhile, so
+        managers keep using the current ones during a rebuild. Returns None if another process is building them
+        """
+        if not INDEXED:
+            logger.error("[DB] Indexed mode is not enabled, enable it on the managers then build the indexes")
+            return None
+        lock = self.acquire_lock(INDEX_BUILD_LOCK, INDEX_BUILD_LOCK_TIMEOUT)
+        if lock is None:
+            logger.info("[DB] Indexes being built by another process")
+            return None
+        building_prefix = "{}/index-building-{}/".format(settings.redis_db, lock)
+        try:
+            logger.notice("[DB] Building indexes for {}".format(settings.redis_db))
+            started_at = time.time()
+            self._add_to_indexes(batch_size, building_prefix)
+            n_keys = self._add_to_indexes(batch_size, building_prefix)
+
+            enabled_at = self.get(self.index_enabled_key)
+            if enabled_at is None or float(enabled_at) > started_at:
+                logger.error("[DB] Indexes not marked ready: no manager was writing in indexed mode when the build "
+                             "started. Enable indexed mode on every manager, restart them, then build again")
+                return None
+
+            n_indexes = 0
+            pipe = self.pipeline()
+            for building_key in self.scan_iter(match="{}*".format(building_prefix), count=batch_size):
+                index_name = self.index_prefix + building_key[len(building_prefix):]
+                pipe.sunionstore(building_key, [building_key, index_name])
+                pipe.rename(building_key, index_name)
+                n_indexes += 1
+                if n_indexes % batch_size == 0:
+                    pipe.execute()
+            pipe.set(self.index_version_key, INDEX_VERSION)
+            pipe.execute()
+            self._index_ready = True
+            logger.notice("[DB] {} keys indexed".format(n_keys))
+            return n_keys
+        except Exception:
+            logger.error("[DB] Failed to build indexes, {}".format(traceback.format_exc(limit=5)))
+        finally:
+            self._end_index_build(lock, building_prefix=building_prefix)
+
+    def expirations_ready(self):
+        """ The expirations index lists all channel credentials once built by build_expirations """
+        try:
+            return bool(self.exists(self.expirations_ready_key))
+        except Exception:
+            logger.error("[DB] Failed to check expirations index. {}".format(traceback.format_exc(limit=5)))
+            return False
+
+    def build_expirations(self, batch_size=1000):
+        """
+        Migration of an existing hash: indexes the expiration date of every channel credentials.
+        Credentials stored afterwards are indexed by set_credentials.
+        The index is built in a temporary key then renamed into place, by one process at a time (lock), and
+        the expirations stored meanwhile are kept. Returns None if another process is building it
+        """
+        lock = self.acquire_lock(INDEX_BUILD_LOCK, INDEX_BUILD_LOCK_TIMEOUT)
+        if lock is None:
+            logger.info("[DB] Credential expirations index being built by another process")
+            return None
+        building_key = "{}/building-{}".format(self.expirations_key, lock)
+        try:
+            logger.notice("[DB] Building credential expirations index for {}".format(settings.redis_db))
+            n_keys = 0
+            pipe = self.pipeline(transaction=False)
+            for item in self.iter_full_query('credential-owners/*/channels/*', fields=['expiration_date'],
+                                             batch_size=batch_size):
+                pipe.zadd(building_key, **{item['key']: expiration_score(item['value'])})
+                n_keys += 1
+                if n_keys % batch_size == 0:
+                    pipe.execute()
+            pipe.execute()
+
+            pipe = self.pipeline()
+            if n_keys:
+                pipe.zunionstore(building_key, [building_key, self.expirations_key], aggregate='MAX')
+                pipe.rename(building_key, self.expirations_key)
+            pipe.set(self.expirations_ready_key, 1)
+            pipe.execute()
+            logger.notice("[DB] {} credential expirations indexed".format(n_keys))
+            return n_keys
+        except Exception:
+            logger.error("[DB] Failed to build expirations index, {}".format(traceback.format_exc(limit=5)))
+        finally:
+            self._end_index_build(lock, building_key)
+
+    def _end_index_build(self, lock, building_key=None, building_prefix=None):
+        """ Deletes the temporary key (or keys under building_prefix) of an index build and releases its lock """
+        try:
+            building_keys = [building_key] if building_key else \
+                list(self.scan_iter(match="{}*".format(building_prefix)))
+            if building_keys:
+                self.delete(*building_keys)
+            self.release_lock(INDEX_BUILD_LOCK, lock)
+        except Exception:
+            logger.error("[DB] Failed to release index build lock, {}".format(traceback.format_exc(limit=5)))
+
+    def get_expiring_credentials(self, until, exclude=None):
+        """
+        Returns channel credentials expiring until the given timestamp (or whose expiration is unknown) as
+        full_query does, except keys in exclude
+        """
+        exclude = exclude or set()
+        keys = [key for key in self.zrangebyscore(self.expirations_key, '-inf', until) if key not in exclude]
+        values = self.get_keys(keys)
+        stale = [key for key in keys if key not in values]
+        if stale:
+            self.remove_missing(self.expirations_key, 'ZREM', stale)
+        return [{'key': key, 'value': values[key]} for key in keys if key in values]
+
+    def refresh_tokens_ready(self):
+        """ The refresh tokens index lists all channel credentials once built by build_refresh_tokens """
+        if not getattr(self, '_refresh_tokens_ready', False):
+            try:
+                self._refresh_tokens_ready = bool(self.exists(self.refresh_tokens_ready_key))
+            except Exception:
+                logger.error("[DB] Failed to check refresh tokens index. {}".format(traceback.format_exc(limit=5)))
+                return False
+        return self._refresh_tokens_ready
+
+    def drop_refresh_tokens(self):
+        keys = list(self.scan_iter(match="{}*".format(self.refresh_tokens_prefix)))
+        keys.extend([self.refresh_token_keys_key, self.refresh_tokens_ready_key])
+        self.delete(*keys)
+        self._refresh_tokens_ready = False
+
+    def build_refresh_tokens(self, batch_size=1000):
+        """
+        Migration of an existing hash: indexes every channel credentials by refresh token digest.
+        Credentials stored afterwards are indexed by set_credentials.
+        Credentials are added to the sets of their digest, stale members being removed when looked up. The hash
+        of the digest of each credentials is built in a temporary key then renamed into place, by one process
+        at a time (lock), and the entries stored meanwhile are kept. Returns None if another process is
+        building it
+        """
+        lock = self.acquire_lock(INDEX_BUILD_LOCK, INDEX_BUILD_LOCK_TIMEOUT)
+        if lock is None:
+            logger.info("[DB] Refresh tokens index being built by another process")
+            return None
+        building_key = "{}/building-{}".format(self.refresh_token_keys_key, lock)
+        try:
+            logger.notice("[DB] Building refresh tokens index for {}".format(settings.redis_db))
+            n_keys = 0
+            pipe = self.pipeline(transaction=False)
+            for item in self.iter_full_query('credential-owners/*/channels/*', fields=['refresh_token', 'data'],
+                                             batch_size=batch_size):
+                refresh_token = refresh_token_of(item['value'])
+                if refresh_token:
+                    digest = refresh_token_digest(refresh_token)
+                    pipe.sadd(self.refresh_tokens_prefix + digest, item['key'])
+                    pipe.hset(building_key, item['key'], digest)
+                n_keys += 1
+                if n_keys % batch_size == 0:
+                    pipe.execute()
+            pipe.execute()
+
+            self.register_script(REPLACE_REFRESH_TOKEN_KEYS_SCRIPT)(
+                keys=[building_key, self.refresh_token_keys_key, self.refresh_tokens_ready_key])
+            self._refresh_tokens_ready = True
+            logger.notice("[DB] {} refresh tokens indexed".format(n_keys))
+            return n_keys
+        except Exception:
+            logger.error("[DB] Failed to build refresh tokens index, {}".format(traceback.format_exc(limit=5)))
+        finally:
+            self._end_index_build(lock, building_key)
+
+    def get_credentials_by_refresh_token(self, refresh_token):
+        """
+        Returns the channel credentials having refresh_token, as full_query does, from the refresh tokens index
+        """
+        digest = refresh_token_digest(refresh_token)
+        index_name = self.refresh_tokens_prefix + digest
+        keys = list(self.smembers(index_name))
+        if not keys:
+            return []
+        values = self.get_keys(keys)
+        stale = [key for key in keys if refresh_token_of(values.get(key)) != refresh_token]
+        if stale:
+            self.register_script(REMOVE_STALE_REFRESH_TOKEN_SCRIPT)(
+                keys=[index_name, self.refresh_token_keys_key], args=[digest] + stale)
+        return [{'key': key, 'value': values[key]} for key in keys if key not in stale]
+
+    def next_expiration(self, exclude=None):
+        """
+        Returns (key, expiration timestamp) of the channel credentials expiring first, except keys in exclude
+        """
+        exclude = exclude or set()
+        entries = self.zrange(self.expirations_key, 0, len(exclude), withscores=True)
+        return next(((key, score) for key, score in entries if key not in exclude), (None, None))
+
+    def acquire_lock(self, name, timeout):
+        """
+        Takes lock name, shared by every process using the same hash, for up to timeout seconds.
+        Returns the token to release it, or None if it's held by another process
+        """
+        token = uuid.uuid4().hex
+        if self.set("{}/locks/{}".format(settings.redis_db, name), token, px=max(int(timeout * 1000), 1), nx=True):
+            return token
+        return None
+
+    def release_lock(self, name, token):
+        """ Releases lock name if still held with token """
+        return bool(self.register_script(RELEASE_LOCK_SCRIPT)(
+            keys=["{}/locks/{}".format(settings.redis_db, name)], args=[token]))
+
     def save_n_exit(self):
         """ To safely exit the opened client """
         try:
@@ -271,19 +891,42 @@ class DBManager(Redis):
         regex = '/'.join(['credential-owners', owner_id, 'channels', channel_id])
         return self.full_query(regex)
 
-    def set_credentials(self, credentials, client_id, owner_id, channel_id=None):
+    @staticmethod
+    def credentials_key(client_id, owner_id, channel_id=None):
         if not client_id or not owner_id:
             raise Exception("[DB] Not enough keys (client or owner missing)")
-        else:
-            credentials['client_id'] = client_id
-            credentials_key = "/".join(['credential-clients',
-                                        client_id, 'owners', owner_id])
+        if channel_id:
+            return "/".join(['credential-owners', owner_id, 'channels', channel_id])
+        return "/".join(['credential-clients', client_id, 'owners', owner_id])
+
+    def set_credentials(self, credentials, client_id, owner_id, channel_id=None):
+        credentials_key = self.credentials_key(client_id, owner_id, channel_id)
+        credentials['client_id'] = client_id
+        self.set_key(credentials_key, credentials)
 
-            if channel_id:
-                credentials_key = "/".join(['credential-owners',
-                                            owner_id, 'channels', channel_id])
+    def set_credentials_many(self, credentials_list):
+        """
+        Stores many credentials in one round trip
+            credentials_list : list of (credentials, client_id, owner_id, channel_id) tuples
+        """
+        mapping = {}
+        for credentials, client_id, owner_id, channel_id in credentials_list:
+            credentials_key = self.credentials_key(client_id, owner_id, channel_id)
+            credentials['client_id'] = client_id
+            mapping[credentials_key] = credentials
+        return self.set_keys(mapping)
 
-            self.set_key(credentials_key, credentials)
+    def get_credentials_many(self, owners_channels):
+        """
+        Retrieves the credentials of many channels in one round trip
+            owners_channels : list of (owner_id, channel_id) tuples
+        Returns a list of {'key': credentials_key, 'value': credentials} of the credentials found,
+        as full_query does
+        """
+        keys = ["/".join(['credential-owners', owner_id, 'channels', channel_id])
+                for owner_id, channel_id in owners_channels]
+        values = self.get_keys(keys)
+        return [{'key': key, 'value': values[key]} for key in keys if key in values]
 
     def update_credentials(self, new_credentials, client_id, owner_id, channel_id):
         new_credentials['client_id'] = client_id
@@ -306,6 +949,21 @@ class DBManager(Redis):
 
         return result
 
+    def get_device_ids(self, channel_ids):
+        """
+        Retrieves the device_id of many channels in one round trip. Returns a dict channel_id: device_id
+        """
+        channel_ids = list(channel_ids)
+        values = self.get_keys(["/".join(['device-channels', channel_id]) for channel_id in channel_ids])
+        device_ids = {}
+        for channel_id in channel_ids:
+            device_id = values.get("/".join(['device-channels', channel_id]))
+            if device_id is None:
+                device_id = self.get_device_id(channel_id)  # legacy keys
+            if device_id is not None:
+                device_ids[channel_id] = device_id
+        return device_ids
+
     def set_device_id(self, channel_id, device_id, add_reverse=False):
         key = "/".join(['device-channels', channel_id])
         self.set_key(key, device_id)
@@ -379,13 +1037,18 @@ class DBManager(Redis):
 
 
 def get_redis():
+    """ Returns a client using the process-wide connection pool """
     try:
-        return DBManager(
-            host=settings.redis_host,
-            port=settings.redis_port,
-            decode_responses=True
-        )
+        return DBManager(connection_pool=get_connection_pool())
     except Exception as e:
         logger.error("[DB] Failed to connect Redis-client to Redis server, {}".format(e))
 
     return None
+
+
+lookup_cache = LookupCache(
+    max_size=CACHE_CONF.get('max_size', DEFAULT_CACHE_MAX_SIZE),
+    ttl=CACHE_CONF.get('ttl_seconds', DEFAULT_CACHE_TTL),
+    channel=INVALIDATION_CHANNEL,
+    redis_factory=get_redis
+) if CACHE_CONF.get('enabled', False) else None
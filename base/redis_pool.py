@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+
+from redis import BlockingConnectionPool
+from redis.exceptions import ConnectionError, TimeoutError
+
+from base import settings, logger
+from base.constants import DEFAULT_REDIS_MAX_CONNECTIONS, DEFAULT_REDIS_POOL_TIMEOUT, \
+    DEFAULT_REDIS_HEALTH_CHECK_INTERVAL
+
+POOL_CONF = settings.config_redis.get('pool', {})
+
+
+class SharedConnectionPool(BlockingConnectionPool):
+    """
+    Connection pool shared by all redis clients of a process (see get_redis), bounded to max_connections:
+    callers wait up to timeout seconds for a free connection instead of opening new ones.
+
+    Connections idle for more than health_check_interval seconds are checked with a PING before being
+    handed out and reconnected if broken. After a fork, the child starts with an empty pool.
+    """
+
+    def __init__(self, health_check_interval=DEFAULT_REDIS_HEALTH_CHECK_INTERVAL, **kwargs):
+        self.health_check_interval = health_check_interval
+        self._inherited_connections = []
+        super().__init__(**kwargs)
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid == os.getpid():
+                    return
+                # Connections inherited from the parent process are still used by it. Keep a reference so they are
+                # never garbage collected here, since Connection.__del__ would shut down the shared socket.
+                self._inherited_connections.append(self._connections)
+                self.reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super().get_connection(command_name, *keys, **options)
+        idle_time = time.monotonic() - getattr(connection, 'last_used', time.monotonic())
+        if self.health_check_interval and connection._sock is not None and idle_time > self.health_check_interval:
+            try:
+                connection.send_command('PING')
+                connection.read_response()
+            except (ConnectionError, TimeoutError, OSError):
+                logger.warning("[DB] Broken redis connection found in pool, reconnecting")
+                connection.disconnect()  # connects again on next command
+        return connection
+
+    def release(self, connection):
+        connection.last_used = time.monotonic()
+        super().release(connection)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SharedConnectionPool(
+                    max_connections=POOL_CONF.get('max_connections', DEFAULT_REDIS_MAX_CONNECTIONS),
+                    timeout=POOL_CONF.get('timeout', DEFAULT_REDIS_POOL_TIMEOUT),
+                    health_check_interval=POOL_CONF.get('health_check_interval', DEFAULT_REDIS_HEALTH_CHECK_INTERVAL),
+                    host=settings.redis_host,
+                    port=int(settings.redis_port),
+                    socket_keepalive=True,
+                    decode_responses=True
+                )
+    return _pool
+
+
+def pool_stats():
+    pool = get_connection_pool()
+    return {
+        'max_connections': pool.max_connections,
+        'created_connections': len(pool._connections),
+        'available_connections': len([conn for conn in list(pool.pool.queue) if conn is not None]),
+    }
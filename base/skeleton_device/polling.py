@@ -2,17 +2,40 @@ import concurrent
 
 from base import settings, logger
 from base.redis_db import get_redis
-from base.utils import rate_limited
-from base.constants import DEFAULT_POLLING_INTERVAL, DEFAULT_RATE_LIMIT, DEFAULT_THREAD_MAX_WORKERS
+from base.rate_limiter import rate_limited, get_bucket
+from base.cluster import get_cluster_member, CLUSTER_ENABLED
+from base.skeleton_device.polling_scheduler import PollingScheduler
+from base.constants import DEFAULT_POLLING_INTERVAL, DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST, \
+    DEFAULT_THREAD_MAX_WORKERS, DEFAULT_POLLING_ENGINE, POLLING_ENGINE_ASYNC, POLLING_ENGINE_THREADS, \
+    DEFAULT_POLLING_CONCURRENCY, DEFAULT_POLLING_CONNECTIONS_PER_HOST, DEFAULT_POLLING_REQUEST_TIMEOUT, \
+    DEFAULT_POLLING_SCHEDULE, POLLING_SCHEDULE_BURST, DEFAULT_POLLING_JITTER, DEFAULT_POLLING_MIN_INTERVAL, \
+    DEFAULT_POLLING_MAX_INTERVAL, DEFAULT_POLLING_BACKOFF, DEFAULT_POLLING_VALIDATORS_STORE, POLLING_VALIDATORS_REDIS, \
+    DEFAULT_CLUSTER_RETRY_INTERVAL, DEFAULT_POLLING_TRACKED_PAYLOADS
 from multiprocessing.pool import ThreadPool
 from itertools import repeat
+from collections import Counter, OrderedDict
 import asyncio
+import hashlib
+import json
 import requests
 import threading
 import datetime
 import time
 import traceback
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+RATE_LIMIT = settings.config_polling.get('rate_limit', DEFAULT_RATE_LIMIT)
+RATE_BURST = settings.config_polling.get('rate_burst', DEFAULT_RATE_BURST)
+SHARED_RATE_LIMIT_KEY = 'polling' if settings.config_polling.get('shared_rate_limit', False) else None
+
+
+def payload_hash(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
 
 class PollingManager(object):
 
@@ -24,6 +47,30 @@ class PollingManager(object):
         self.db = get_redis()
         self.implementer = implementer
         self.pool_requests = None
+        self.device_ids = {}
+        self.engine = settings.config_polling.get('engine', DEFAULT_POLLING_ENGINE)
+        self.concurrency = settings.config_polling.get('concurrency', DEFAULT_POLLING_CONCURRENCY)
+        self.connections_per_host = settings.config_polling.get('connections_per_host',
+                                                                DEFAULT_POLLING_CONNECTIONS_PER_HOST)
+        self.request_timeout = settings.config_polling.get('request_timeout', DEFAULT_POLLING_REQUEST_TIMEOUT)
+        self.session = None
+        self.rate_limiter = None
+        self.callback_executor = None
+        self.schedule = settings.config_polling.get('schedule', DEFAULT_POLLING_SCHEDULE)
+        self.jitter = settings.config_polling.get('jitter', DEFAULT_POLLING_JITTER)
+        self.scheduler = None
+        self.adaptive = settings.config_polling.get('adaptive', False)
+        self.payload_hashes = OrderedDict()  # (channel_id, endpoint): payload hash, least recently polled first
+        self.payload_hashes_lock = threading.Lock()
+        self.tracked_payloads = settings.config_polling.get('tracked_payloads', DEFAULT_POLLING_TRACKED_PAYLOADS)
+        self.intervals_key = f"{settings.redis_db}/polling/intervals"
+        self.conditional_requests = settings.config_polling.get('conditional_requests', False)
+        self.validators_store = settings.config_polling.get('validators_store', DEFAULT_POLLING_VALIDATORS_STORE)
+        self.validators = {}
+        self.validators_key = f"{settings.redis_db}/polling/validators"
+        self.deduplicate = settings.config_polling.get('deduplicate', False)
+        self.metrics_key = f"{settings.redis_db}/polling/metrics"
+        self.cluster = None
 
     def start(self):
         """
@@ -35,8 +82,17 @@ class PollingManager(object):
                 conf_data = self.implementer.get_polling_conf()
                 if type(conf_data) is not list:
                     conf_data = [conf_data]
-                n_processes = settings.config_polling.get('requests_pool', DEFAULT_THREAD_MAX_WORKERS)
-                self.pool_requests = ThreadPool(processes=n_processes)
+                if self.engine == POLLING_ENGINE_ASYNC and aiohttp is None:
+                    logger.warning('[Polling] aiohttp is not installed, using threads engine')
+                    self.engine = POLLING_ENGINE_THREADS
+
+                if self.engine == POLLING_ENGINE_ASYNC:
+                    self.rate_limiter = get_bucket(RATE_LIMIT, RATE_BURST, SHARED_RATE_LIMIT_KEY)
+                    # implementer.polling runs out of the event loop, one response at a time
+                    self.callback_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                else:
+                    n_processes = settings.config_polling.get('requests_pool', DEFAULT_THREAD_MAX_WORKERS)
+                    self.pool_requests = ThreadPool(processes=n_processes)
                 self.thread = threading.Thread(target=self.worker, args=[conf_data],
                                                name="Polling")
                 self.thread.daemon = True
@@ -61,19 +117,110 @@ class PollingManager(object):
         asyncio.set_event_loop(self.loop)
         loop = asyncio.get_event_loop()
 
+        if self.schedule == POLLING_SCHEDULE_BURST:
+            while True:
+                logger.info('[Polling] new polling request {}'.format(datetime.datetime.now()))
+                try:
+                    self.join_cluster()
+                    loop.run_until_complete(self.make_requests(conf_data))
+                except Exception:
+                    logger.error(f'[Polling] Error on worker loop, {traceback.format_exc(limit=5)}')
+                time.sleep(self.interval)
+
+        self.scheduler = PollingScheduler(
+            conf_data, self.interval, self.jitter,
+            min_interval=settings.config_polling.get('min_interval_seconds', DEFAULT_POLLING_MIN_INTERVAL),
+            max_interval=settings.config_polling.get('max_interval_seconds', DEFAULT_POLLING_MAX_INTERVAL),
+            backoff=settings.config_polling.get('backoff_factor', DEFAULT_POLLING_BACKOFF) if self.adaptive else 1.0
+        )
+        next_update = 0
+        cluster_version = None
+        intervals_reset = CLUSTER_ENABLED  # adapted intervals are shared by the members of a cluster
         while True:
-            logger.info('[Polling] new polling request {}'.format(datetime.datetime.now()))
             try:
-                loop.run_until_complete(self.make_requests(conf_data))
+                self.join_cluster()
+                if not intervals_reset:
+                    self.db.delete(self.intervals_key)
+                    intervals_reset = True
+                now = time.monotonic()
+                if now >= next_update or (self.cluster is not None and self.cluster.version != cluster_version):
+                    cluster_version = self.cluster.version if self.cluster is not None else None
+                    all_channels = self.db.get_channels()
+                    new_channels = self.scheduler.update_channels(self.owned_channels(all_channels), now)
+                    self.forget_channels()
+                    self.forget_validators(all_channels)
+                    logger.info(f'[Polling] {len(self.scheduler.channels)} channels scheduled, '
+                                f'{len(new_channels)} new {datetime.datetime.now()}')
+                    next_update = now + self.interval
+
+                targets = self.claim(self.scheduler.pop_due(now))
+                if targets:
+                    loop.run_until_complete(self.poll(targets))
             except Exception:
                 logger.error(f'[Polling] Error on worker loop, {traceback.format_exc(limit=5)}')
-            time.sleep(self.interval)
+                next_update = max(next_update, time.monotonic() + DEFAULT_CLUSTER_RETRY_INTERVAL)
+
+            wake_up = min(self.scheduler.next_due() or next_update, next_update)
+            time.sleep(max(wake_up - time.monotonic(), 0))
+
+    def join_cluster(self):
+        """
+        When sharing the polling with other manager instances (cluster), joins them if not yet done: nothing is
+        polled until then
+        """
+        if self.cluster is None:
+            self.cluster = get_cluster_member('polling')
 
     async def make_requests(self, conf_data):
+        """
+        Polls all channels at once
+        """
         try:
             logger.info(f"[Polling] {threading.currentThread().getName()} starting {datetime.datetime.now()}")
+            all_channels = self.db.get_channels()
+            channels = self.owned_channels(all_channels)
+            await self.poll(self.claim([(channel_id, conf_data) for channel_id in channels]))
+            await asyncio.get_event_loop().run_in_executor(None, self.forget_validators, all_channels)
+            logger.info("[Polling] {} finishing {}".format(threading.currentThread().getName(),
+                                                           datetime.datetime.now()))
+        except Exception:
+            logger.error("[Polling] Error on make_requests: {}".format(traceback.format_exc(limit=5)))
+
+    def owned_channels(self, channels):
+        """
+        When sharing the polling with other manager instances (cluster), keeps the channels assigned to this one
+        """
+        if self.cluster is None:
+            return channels
+        return [channel_id for channel_id in channels if self.cluster.owns(channel_id)]
+
+    def claim(self, targets):
+        """
+        When sharing the polling with other manager instances (cluster), keeps the targets whose channel lease
+        could be taken, for half its interval: no other instance polls it meanwhile, even while rebalancing
+        """
+        if self.cluster is None or not targets:
+            return targets
+        leases = {
+            channel_id: (self.scheduler.current_interval(channel_id) if self.scheduler else self.interval) / 2
+            for channel_id, _ in targets
+        }
+        claimed = set(self.cluster.claim(leases))
+        return [(channel_id, conf_data) for channel_id, conf_data in targets if channel_id in claimed]
 
+    async def poll(self, targets):
+        """
+        :param targets: list of (channel_id, conf_data)
+        """
+        if self.engine == POLLING_ENGINE_ASYNC:
+            await self.poll_async(targets)
+        else:
+            await self.poll_threads(targets)
+
+    async def poll_threads(self, targets):
+        try:
             loop = asyncio.get_event_loop()
+            self.prefetch_device_ids(targets)
 
             with concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_MAX_WORKERS) as executor:
                 futures = [
@@ -82,19 +229,182 @@ class PollingManager(object):
                         self.send_request,
                         conf_data, channel_id
                     )
-                    for channel_id in self.db.get_channels()
+                    for channel_id, conf_data in targets
                 ]
-                for response in await asyncio.gather(*futures):
+                counters = Counter()
+                for (channel_id, conf_data), response in zip(targets, await asyncio.gather(*futures)):
                     if response:
-                        for resp in response:
+                        for resp in self.track_changes(channel_id, response, counters):
                             self.implementer.polling(resp)
+                self.save_metrics(counters)
+        except Exception:
+            logger.error("[Polling] Error on poll_threads: {}".format(traceback.format_exc(limit=5)))
 
-            logger.info("[Polling] {} finishing {}".format(threading.currentThread().getName(),
-                                                           datetime.datetime.now()))
+    async def poll_async(self, targets):
+        """
+        Polls up to `concurrency` channels at the same time over keep-alive connections, handing each channel
+        responses to implementer.polling as soon as they are received
+        """
+        try:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.prefetch_device_ids, targets)
+
+            if self.session is None or self.session.closed:
+                self.session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.connections_per_host),
+                    timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+                )
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def poll_channel(channel_id, conf_data):
+                return channel_id, conf_data, await self.send_request_async(conf_data, channel_id, semaphore)
+
+            counters = Counter()
+            for request in asyncio.as_completed([poll_channel(*target) for target in targets]):
+                channel_id, conf_data, response = await request
+                if response:
+                    # may store the adapted interval of the channel in redis
+                    for resp in await loop.run_in_executor(None, self.track_changes, channel_id, response, counters):
+                        await loop.run_in_executor(self.callback_executor, self.implementer.polling, resp)
+            await loop.run_in_executor(None, self.save_metrics, counters)
         except Exception:
-            logger.error("[Polling] Error on make_requests: {}".format(traceback.format_exc(limit=5)))
+            logger.error("[Polling] Error on poll_async: {}".format(traceback.format_exc(limit=5)))
+
+    def track_changes(self, channel_id, resp_list, counters):
+        """
+        Compares the payload hash of each channel endpoint response to the previous one: adapts the channel
+        polling interval and, if deduplicate is enabled, leaves out unchanged payloads.
+        Returns the responses to hand to implementer.polling
+        """
+        track = self.deduplicate or (self.scheduler is not None and self.scheduler.adaptive)
+        changed = None
+        new_responses = []
+        for resp in resp_list:
+            counters['requests'] += 1
+            endpoint = resp.pop('endpoint', None)
+            if resp.pop('not_modified', False):
+                counters['not_modified'] += 1
+                changed = changed or False
+                continue
+            if not track:
+                new_responses.append(resp)
+                continue
+
+            key = (channel_id, endpoint)
+            digest = payload_hash(resp['response'])
+            previous_digest = self.track_payload(key, digest)
+            if previous_digest is not None:
+                changed = changed or digest != previous_digest
+            if self.deduplicate and digest == previous_digest:
+                counters['duplicates'] += 1
+                continue
+            new_responses.append(resp)
+
+        if changed is not None and self.scheduler is not None and self.scheduler.adaptive:
+            previous_interval = self.scheduler.current_interval(channel_id)
+            interval = self.scheduler.report(channel_id, changed)
+            if interval != previous_interval:
+                logger.debug(f'[Polling] channel {channel_id} interval {previous_interval}s -> {interval}s')
+                self.db.hset(self.intervals_key, channel_id, interval)
+        return new_responses
+
+    def track_payload(self, key, digest):
+        """
+        Keeps the payload hash of a channel endpoint, returning the previous one. Only the last tracked_payloads
+        endpoints polled are kept
+        """
+        with self.payload_hashes_lock:
+            previous_digest = self.payload_hashes.pop(key, None)
+            self.payload_hashes[key] = digest
+            while len(self.payload_hashes) > self.tracked_payloads:
+                self.payload_hashes.popitem(last=False)
+        return previous_digest
+
+    def save_metrics(self, counters):
+        if not counters:
+            return
+        pipe = self.db.pipeline()
+        for counter, value in counters.items():
+            pipe.hincrby(self.metrics_key, counter, value)
+        pipe.execute()
+        if counters['not_modified'] or counters['duplicates']:
+            logger.info(f"[Polling] {counters['requests']} requests, {counters['not_modified']} not modified, "
+                        f"{counters['duplicates']} duplicates not handed to polling")
+
+    def get_metrics(self):
+        """
+        Returns counters of polling requests answered, not modified (conditional requests) and duplicates
+        skipped, from any process
+        """
+        metrics = {counter: int(value) for counter, value in self.db.hgetall(self.metrics_key).items()}
+        for counter in ('requests', 'not_modified', 'duplicates'):
+            metrics.setdefault(counter, 0)
+        metrics['saved'] = metrics['not_modified'] + metrics['duplicates']
+        return metrics
+
+    def get_validators(self, key):
+        if self.validators_store == POLLING_VALIDATORS_REDIS:
+            value = self.db.hget(self.validators_key, key)
+            return json.loads(value) if value else {}
+        return self.validators.get(key, {})
+
+    def set_validators(self, key, headers):
+        """
+        Keeps the ETag and Last-Modified headers of a response, sent back on the next request of the endpoint
+        """
+        validators = {header: headers[header] for header in ('ETag', 'Last-Modified') if headers.get(header)}
+        if not validators or validators == self.validators.get(key):
+            return
+        self.validators[key] = validators
+        if self.validators_store == POLLING_VALIDATORS_REDIS:
+            self.db.hset(self.validators_key, key, json.dumps(validators))
+
+    def forget_channels(self):
+        """
+        Drops change tracking of channels no longer scheduled
+        """
+        with self.payload_hashes_lock:
+            removed = {channel_id for channel_id, _ in self.payload_hashes} - self.scheduler.channels
+            if removed:
+                self.payload_hashes = OrderedDict((key, digest) for key, digest in self.payload_hashes.items()
+                                                  if key[0] not in removed)
+        if removed:
+            # channels moved to another member (cluster) keep the interval it adapts
+            deleted = [channel_id for channel_id in removed if self.cluster is None or self.cluster.owns(channel_id)]
+            if deleted:
+                self.db.hdel(self.intervals_key, *deleted)
+        self.validators = {key: validators for key, validators in self.validators.items()
+                           if key.split(' ', 1)[0] in self.scheduler.channels}
 
-    @rate_limited(settings.config_polling.get('rate_limit', DEFAULT_RATE_LIMIT))
+    def forget_validators(self, channels):
+        """
+        Drops the validators of channels no longer stored (deleted). Those kept in redis are shared by every
+        manager, any of them drops them
+        """
+        channels = set(channels)
+        self.validators = {key: validators for key, validators in self.validators.items()
+                           if key.split(' ', 1)[0] in channels}
+        if self.validators_store == POLLING_VALIDATORS_REDIS:
+            deleted = [key for key, _ in self.db.hscan_iter(self.validators_key)
+                       if key.split(' ', 1)[0] not in channels]
+            if deleted:
+                self.db.hdel(self.validators_key, *deleted)
+
+    def get_channel_intervals(self):
+        """
+        Returns the current polling interval of channels whose interval was adapted, from any process
+        """
+        return {channel_id: float(interval) for channel_id, interval in self.db.hgetall(self.intervals_key).items()}
+
+    def prefetch_device_ids(self, targets):
+        channels = [channel_id for channel_id, conf_data in targets
+                    if any('{device_id}' in endpoint_conf.get('url', '') for endpoint_conf in conf_data)]
+        if channels:
+            self.device_ids = self.db.get_device_ids(channels)
+
+    @rate_limited(RATE_LIMIT, burst=RATE_BURST, max_concurrency=settings.config_polling.get('max_concurrency'),
+                  shared_key=SHARED_RATE_LIMIT_KEY)
     def send_request(self, conf_data, channel_id):
         try:
             # validate if channel exists
@@ -105,17 +415,7 @@ class PollingManager(object):
                 cred_key = credential_dict['key']
                 credentials = credential_dict['value']
 
-                is_valid = self.validate_channel(cred_key)
-                if not is_valid:
-                    logger.debug('[Polling] Invalid channel {}'.format(cred_key))
-                    continue
-
-                # Validate if token is valid before the request
-                now = int(time.time())
-                token_expiration_date = credentials['expiration_date']
-                if now > token_expiration_date and not token_expiration_date == 0:
-                    logger.debug("[Polling] access token expired {} - now:{}, expiration:{}".format(
-                        cred_key, now, token_expiration_date))
+                if not self.check_credentials(cred_key, credentials):
                     continue
 
                 resp_list = []
@@ -134,6 +434,50 @@ class PollingManager(object):
         logger.notice('[Polling] No valid credentials found for channel {}'.format(channel_id))
         return False
 
+    async def send_request_async(self, conf_data, channel_id, semaphore):
+        loop = asyncio.get_event_loop()
+        async with semaphore:
+            try:
+                credentials_list = await loop.run_in_executor(
+                    None, self.db.full_query, 'credential-owners/*/channels/{}'.format(channel_id))
+                logger.info('[Polling] {} results found for channel_id: {}'.format(len(credentials_list), channel_id))
+
+                for credential_dict in credentials_list:  # try until we find valid credentials
+                    cred_key = credential_dict['key']
+                    credentials = credential_dict['value']
+
+                    if not await loop.run_in_executor(None, self.check_credentials, cred_key, credentials):
+                        continue
+
+                    await self.rate_limiter.acquire_async()
+                    results = await asyncio.gather(*[
+                        self.get_response_async(endpoint_conf, credentials, channel_id, cred_key)
+                        for endpoint_conf in conf_data
+                    ])
+                    resp_list = [result for result in results if result]
+
+                    if resp_list:
+                        return resp_list
+            except Exception:
+                logger.error(f'[Polling] Unknown error on polling.send_request_async {traceback.format_exc(limit=5)}')
+        logger.notice('[Polling] No valid credentials found for channel {}'.format(channel_id))
+        return False
+
+    def check_credentials(self, cred_key, credentials):
+        is_valid = self.validate_channel(cred_key)
+        if not is_valid:
+            logger.debug('[Polling] Invalid channel {}'.format(cred_key))
+            return False
+
+        # Validate if token is valid before the request
+        now = int(time.time())
+        token_expiration_date = credentials['expiration_date']
+        if now > token_expiration_date and not token_expiration_date == 0:
+            logger.debug("[Polling] access token expired {} - now:{}, expiration:{}".format(
+                cred_key, now, token_expiration_date))
+            return False
+        return True
+
     def validate_channel(self, credential_key):
         try:
             channel_id = credential_key.split('/')[-1]
@@ -149,31 +493,81 @@ class PollingManager(object):
         """
         If {device_id} in url to replace with real device_id
         """
-        device_id = self.db.get_device_id(channel_id)
+        device_id = self.device_ids.get(channel_id) or self.db.get_device_id(channel_id)
         if device_id:
             url = url.format(device_id=device_id)
         return url
 
-    def get_response(self, endpoint_conf, credentials, channel_id, cred_key):
-        url = endpoint_conf['url']
+    def build_request(self, endpoint_conf, credentials, channel_id):
+        """
+        Returns method, url, endpoint name and keyword arguments of the request described by an item of
+        get_polling_conf
+        """
         method = endpoint_conf['method']
-        data = endpoint_conf.get('data')
-        params = endpoint_conf.get('params')
-
+        url = endpoint_conf['url']
         if '{device_id}' in url:
-            url = self.replace_device_id(url, cred_key.split('/')[-1])
+            url = self.replace_device_id(url, channel_id)
+
+        endpoint = f"{method.upper()} {url}"
+        headers = self.authorization(credentials)
+        if self.conditional_requests:
+            validators = self.get_validators(f"{channel_id} {endpoint}")
+            if validators.get('ETag'):
+                headers['If-None-Match'] = validators['ETag']
+            if validators.get('Last-Modified'):
+                headers['If-Modified-Since'] = validators['Last-Modified']
 
-        response = requests.request(method, url, params=params, data=data,
-                                    headers=self.authorization(credentials))
+        return method, url, endpoint, {
+            'params': endpoint_conf.get('params'),
+            'data': endpoint_conf.get('data'),
+            'headers': headers
+        }
+
+    def get_response(self, endpoint_conf, credentials, channel_id, cred_key):
+        method, url, endpoint, kwargs = self.build_request(endpoint_conf, credentials, channel_id)
+        response = requests.request(method, url, timeout=self.request_timeout, **kwargs)
 
-        if response.status_code == requests.codes.ok:
+        if response.status_code == requests.codes.not_modified:
+            logger.debug('[Polling] {} not modified for {}'.format(endpoint, cred_key))
+            return {'not_modified': True, 'endpoint': endpoint}
+        elif response.status_code == requests.codes.ok:
             logger.info('[Polling] polling request successful with {}'.format(cred_key))
+            if self.conditional_requests:
+                self.set_validators(f"{channel_id} {endpoint}", response.headers)
             return {
                 'response': response.json(),
                 'channel_id': channel_id,
-                'credentials': credentials
+                'credentials': credentials,
+                'endpoint': endpoint
             }
         else:
             logger.warning(f'[Polling] Error in polling request: CHANNEL_ID: {channel_id}; '
                            f'URL: {url}; RESPONSE: {response}')
             return {}
+
+    async def get_response_async(self, endpoint_conf, credentials, channel_id, cred_key):
+        loop = asyncio.get_event_loop()
+        # device_id and validators may be read from redis, out of the event loop
+        method, url, endpoint, kwargs = await loop.run_in_executor(
+            None, self.build_request, endpoint_conf, credentials, channel_id)
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                if response.status == requests.codes.not_modified:
+                    logger.debug('[Polling] {} not modified for {}'.format(endpoint, cred_key))
+                    return {'not_modified': True, 'endpoint': endpoint}
+                elif response.status == requests.codes.ok:
+                    logger.info('[Polling] polling request successful with {}'.format(cred_key))
+                    if self.conditional_requests:
+                        await loop.run_in_executor(None, self.set_validators, f"{channel_id} {endpoint}",
+                                                   response.headers)
+                    return {
+                        'response': await response.json(content_type=None),
+                        'channel_id': channel_id,
+                        'credentials': credentials,
+                        'endpoint': endpoint
+                    }
+                logger.warning(f'[Polling] Error in polling request: CHANNEL_ID: {channel_id}; '
+                               f'URL: {url}; RESPONSE: {response.status}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f'[Polling] Request Error on polling.get_response_async {url}: {e!r}')
+        return {}
@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import math
+import random
+import time
+
+
+class PollingScheduler:
+    """
+    Gives each channel its own due time for every polling interval found in the polling conf (an endpoint conf
+    may define its own interval_seconds). Channels are spread evenly, with jitter, across the interval and keep a
+    fixed cadence: a channel is due again one interval after its previous due time, whatever the polling took.
+
+    When adaptive (backoff > 1), the intervals of each channel are multiplied by backoff every time its data
+    is reported unchanged and divided by it when changed, the default interval staying within min_interval
+    and max_interval (the others are scaled alike).
+    """
+
+    def __init__(self, conf_data, interval, jitter=1.0, min_interval=None, max_interval=None, backoff=1.0):
+        """
+        :param conf_data: list of endpoint confs, as returned by get_polling_conf
+        :param interval: default interval, for endpoint confs without interval_seconds
+        :param jitter: 0 to 1, fraction of the slot of each channel in which it's randomly placed
+        """
+        self.interval = interval
+        self.groups = {}
+        for endpoint_conf in conf_data:
+            self.groups.setdefault(endpoint_conf.get('interval_seconds', interval), []).append(endpoint_conf)
+        self.jitter = min(max(jitter, 0.0), 1.0)
+        self.backoff = backoff
+        self.min_factor = min((min_interval or interval) / interval, 1.0)
+        self.max_factor = max((max_interval or interval) / interval, 1.0)
+        self.factors = {}
+        self.channels = set()
+        self._heap = []
+        self._due = {}  # (channel_id, interval): due time, heap entries with a different time are outdated
+        self._seq = itertools.count()
+
+    def _push(self, due_time, channel_id, interval):
+        self._due[(channel_id, interval)] = due_time
+        heapq.heappush(self._heap, (due_time, next(self._seq), channel_id, interval))
+
+    def update_channels(self, channels, now=None):
+        """
+        Schedules channels found for the first time, spread across the next interval. Channels no longer
+        found are dropped when due
+        """
+        now = time.monotonic() if now is None else now
+        new_channels = [channel_id for channel_id in dict.fromkeys(channels) if channel_id not in self.channels]
+        self.channels = set(channels)
+        self.factors = {channel_id: factor for channel_id, factor in self.factors.items()
+                        if channel_id in self.channels}
+
+        for interval in self.groups:
+            for n, channel_id in enumerate(new_channels):
+                offset = interval * (n + random.random() * self.jitter) / len(new_channels)
+                self._push(now + offset, channel_id, interval)
+        return new_channels
+
+    @property
+    def adaptive(self):
+        return self.backoff > 1
+
+    def current_interval(self, channel_id, interval=None):
+        return (interval or self.interval) * self.factors.get(channel_id, 1.0)
+
+    def report(self, channel_id, changed, now=None):
+        """
+        Adapts the intervals of a channel to its data having changed or not since it was last polled, polling
+        it sooner if already scheduled past its new interval. Returns the channel current default interval
+        """
+        if self.adaptive:
+            factor = self.factors.get(channel_id, 1.0)
+            factor = factor / self.backoff if changed else factor * self.backoff
+            self.factors[channel_id] = min(max(factor, self.min_factor), self.max_factor)
+
+            if changed:
+                now = time.monotonic() if now is None else now
+                for interval in self.groups:
+                    due_time = self._due.get((channel_id, interval))
+                    sooner = now + self.current_interval(channel_id, interval)
+                    if due_time is not None and sooner < due_time:
+                        self._push(sooner, channel_id, interval)
+        return self.current_interval(channel_id)
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Returns a list of (channel_id, conf_data) due until now, each channel once with the endpoint confs due
+        """
+        now = time.monotonic() if now is None else now
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            due_time, _, channel_id, interval = heapq.heappop(self._heap)
+            if self._due.get((channel_id, interval)) != due_time:
+                continue
+            if channel_id not in self.channels:
+                del self._due[(channel_id, interval)]
+                continue
+
+            current_interval = self.current_interval(channel_id, interval)
+            next_time = due_time + current_interval
+            if next_time <= now:  # fell behind, skip the missed cycles but keep the channel slot
+                next_time += current_interval * (math.floor((now - next_time) / current_interval) + 1)
+            self._push(next_time, channel_id, interval)
+            due.setdefault(channel_id, []).extend(self.groups[interval])
+        return list(due.items())
+
+    def __len__(self):
+        return len(self._due)
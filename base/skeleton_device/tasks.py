@@ -1,4 +1,4 @@
-from base.thread_pool import pool_task
+from base.thread_pool import pool_task, current_cancel_token
 from base import settings, logger
 from .token_refresher import TokenRefresherManager
 
@@ -7,6 +7,7 @@ from .token_refresher import TokenRefresherManager
 def handle_credentials(credentials, old_credentials, client_id, owner_id, channel_id, ignore_keys=None):
     from base.solid import implementer
     refresher = TokenRefresherManager(implementer=implementer)
+    cancel_token = current_cancel_token()
     ignore_keys = ignore_keys or []
 
     logger.debug("\n\n\n\n\n\t\t\t\t\t*******************HANDLE_CREDENTIALS****************************")
@@ -36,12 +37,14 @@ def handle_credentials(credentials, old_credentials, client_id, owner_id, channe
             ignore_keys.extend(error_keys)
             updated_cred.extend(updated_)
 
+            cancel_token.raise_if_cancelled()
             logger.debug(f"[handle_credentials] Starting update all owners for channel: {channel_id}")
             updated_, error_keys = refresher.update_all_owners(credentials, channel_id, ignore_keys)
             ignore_keys.extend(updated_)
             ignore_keys.extend(error_keys)
             updated_cred.extend(updated_)
 
+            cancel_token.raise_if_cancelled()
             logger.debug("[handle_credentials] Starting update all channels")
             updated_cred.extend(refresher.update_all_channels(credentials, owner_id, ignore_keys))
 
@@ -2,10 +2,12 @@ import concurrent
 
 from base import settings, logger
 from base.redis_db import get_redis
-from base.utils import rate_limited
-from base.constants import DEFAULT_REFRESH_INTERVAL, DEFAULT_RATE_LIMIT, DEFAULT_THREAD_MAX_WORKERS, \
-    DEFAULT_BEFORE_EXPIRES
+from base.rate_limiter import rate_limited
+from base.cluster import get_cluster_member
+from base.constants import DEFAULT_REFRESH_INTERVAL, DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST, \
+    DEFAULT_THREAD_MAX_WORKERS, DEFAULT_BEFORE_EXPIRES, DEFAULT_CLUSTER_RETRY_INTERVAL
 import asyncio
+import hashlib
 import requests
 import threading
 import datetime
@@ -26,6 +28,8 @@ class TokenRefresherManager(object):
         self.implementer = implementer
         self._channel_relations = {}
         self._channel_template = None
+        self.cluster = None
+        self.retry_at = {}  # credentials key: time before which it isn't loaded again, when due but not refreshed
 
     @property
     def channel_relations(self):
@@ -72,15 +76,65 @@ class TokenRefresherManager(object):
         loop = asyncio.get_event_loop()
 
         while True:
+            try:
+                # when sharing the refresh (cluster), nothing is refreshed until this instance joins
+                self.cluster = self.cluster or get_cluster_member('token-refresher')
+                if not self.db.expirations_ready():
+                    self.db.build_expirations()
+                if not self.db.refresh_tokens_ready():
+                    self.db.build_refresh_tokens()
+            except Exception:
+                logger.error(f"[TokenRefresher] Error starting refresh process: {traceback.format_exc(limit=5)}")
+                time.sleep(min(self.interval, DEFAULT_CLUSTER_RETRY_INTERVAL))
+                continue
+
             logger.info('[TokenRefresher] new refresh process {}'.format(datetime.datetime.now()))
             loop.run_until_complete(self.make_requests(conf_data))
-            time.sleep(self.interval)
+            time.sleep(self.next_wake_up())
             del self.channel_relations
 
+    def next_wake_up(self):
+        """
+        Seconds until the next credentials are due (within before_expires of their expiration), at most interval
+        """
+        try:
+            if self.db.expirations_ready():
+                now = time.time()
+                _, expiration = self.db.next_expiration(exclude=self.retry_at.keys())
+                due_times = list(self.retry_at.values())
+                if expiration is not None:
+                    due_times.append(expiration - self.before_expires)
+                if due_times:
+                    return min(max(min(due_times) - now, 1), self.interval)
+        except Exception:
+            logger.error(f"[TokenRefresher] Error on next_wake_up: {traceback.format_exc(limit=5)}")
+        return self.interval
+
+    def get_due_credentials_by_refresh_token(self):
+        """
+        Loads only the credentials due to be refreshed, from the expirations index. Credentials still due after
+        being tried (e.g. refresh failed) are tried again after interval seconds
+        """
+        now = time.time()
+        self.retry_at = {key: retry_at for key, retry_at in self.retry_at.items() if retry_at > now}
+        credentials = {}
+        for cred_dict in self.db.get_expiring_credentials(now + self.before_expires, exclude=self.retry_at):
+            self.retry_at[cred_dict['key']] = now + self.interval
+            cred_dict['value'] = self.implementer.auth_response(cred_dict['value'])
+            credentials.setdefault(cred_dict['value'].get('refresh_token'), []).append(cred_dict)
+        return credentials
+
     def get_credentials_by_refresh_token(self, refresh_lookup=None):
-        credentials_redis = self.db.full_query('credential-owners/*/channels/*')
+        if refresh_lookup and self.db.refresh_tokens_ready():
+            credentials = []
+            for cred_dict in self.db.get_credentials_by_refresh_token(refresh_lookup):
+                cred_dict['value'] = self.implementer.auth_response(cred_dict['value'])
+                if cred_dict['value'].get('refresh_token') == refresh_lookup:
+                    credentials.append(cred_dict)
+            return credentials
+
         credentials = {}
-        for cred_dict in credentials_redis:
+        for cred_dict in self.db.iter_full_query('credential-owners/*/channels/*'):
             cred_dict['value'] = self.implementer.auth_response(cred_dict['value'])
             refresh_token = cred_dict['value'].get('refresh_token')
             if not refresh_lookup or refresh_lookup == refresh_token:
@@ -90,12 +144,30 @@ class TokenRefresherManager(object):
                     credentials[refresh_token] = [cred_dict]
         return credentials if not refresh_lookup or refresh_lookup not in credentials else credentials[refresh_lookup]
 
+    def claim(self, credentials_by_token):
+        """
+        When sharing the refresh with other manager instances (cluster), keeps the refresh tokens assigned to
+        this one whose lease could be taken: no other instance refreshes them meanwhile, even while rebalancing
+        """
+        if self.cluster is None:
+            return credentials_by_token
+        token_keys = {hashlib.sha1(str(refresh_token).encode()).hexdigest(): refresh_token
+                      for refresh_token in credentials_by_token}
+        owned = [token_key for token_key in token_keys if self.cluster.owns(token_key)]
+        claimed = self.cluster.claim({token_key: self.interval / 2 for token_key in owned})
+        return {token_keys[token_key]: credentials_by_token[token_keys[token_key]] for token_key in claimed}
+
     async def make_requests(self, conf_data: dict):
         try:
             logger.info("[TokenRefresher] {} starting {}".format(threading.currentThread().getName(),
                                                                  datetime.datetime.now()))
 
             loop = asyncio.get_event_loop()
+            if self.db.expirations_ready():
+                credentials_by_token = self.get_due_credentials_by_refresh_token()
+            else:
+                credentials_by_token = self.get_credentials_by_refresh_token()
+            logger.info(f"[TokenRefresher] {len(credentials_by_token)} refresh tokens to check")
 
             with concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_MAX_WORKERS) as executor:
                 futures = [
@@ -104,7 +176,7 @@ class TokenRefresherManager(object):
                         self.send_request,
                         refresh_token, credentials, conf_data
                     )
-                    for refresh_token, credentials in self.get_credentials_by_refresh_token().items()
+                    for refresh_token, credentials in self.claim(credentials_by_token).items()
                 ]
                 for response in await asyncio.gather(*futures):
                     if response:
@@ -115,7 +187,10 @@ class TokenRefresherManager(object):
         except Exception:
             logger.error(f"[TokenRefresher] Error on make_requests: {traceback.format_exc(limit=5)}")
 
-    @rate_limited(settings.config_refresh.get('rate_limit', DEFAULT_RATE_LIMIT))
+    @rate_limited(settings.config_refresh.get('rate_limit', DEFAULT_RATE_LIMIT),
+                  burst=settings.config_refresh.get('rate_burst', DEFAULT_RATE_BURST),
+                  max_concurrency=settings.config_refresh.get('max_concurrency'),
+                  shared_key='token-refresher' if settings.config_refresh.get('shared_rate_limit', False) else None)
     def send_request(self, refresh_token, credentials_list, conf):
         try:
             if credentials_list and type(credentials_list) is not list:
@@ -200,10 +275,16 @@ class TokenRefresherManager(object):
                         logger.debug(f"[TokenRefresher] Update new credentials in DB")
                         self.db.set_credentials(new_credentials, client_app_id, owner_id, channel_id)
 
-                        # Check list size because this could be called from implementer.access_check
-                        if len(credentials_list) == 1:
+                        # The old refresh token is no longer valid: every channel using it gets the new
+                        # credentials, not only the ones listed (e.g. only the due ones, or the single one
+                        # from implementer.access_check). Without the refresh tokens index that would scan
+                        # every credentials for each refresh, the listed ones are updated
+                        if self.db.refresh_tokens_ready():
                             logger.debug(f"[TokenRefresher] Trying to find credentials using old refresh token")
-                            credentials_list = self.get_credentials_by_refresh_token(credentials['refresh_token'])
+                            listed_keys = {cred_['key'] for cred_ in credentials_list}
+                            credentials_list = credentials_list + [
+                                cred_ for cred_ in self.get_credentials_by_refresh_token(refresh_token)
+                                if cred_['key'] not in listed_keys]
                         credentials_list = [cred_ for cred_ in credentials_list if cred_['key'] != key]
 
                         self.update_credentials(new_credentials, credentials_list)
@@ -290,6 +371,7 @@ class TokenRefresherManager(object):
         error_keys = [cred_['key'] for cred_ in old_credentials_list if cred_['has_error'] is True]
         old_credentials_list = self.filter_credentials(old_credentials_list, new_credentials.get('client_man_id'))
         updated_credentials = []
+        stored_credentials = []
         logger.info(f'[TokenRefresher] update_credentials: {len(old_credentials_list)} keys to update')
         for cred_ in old_credentials_list:
             key = cred_['key']
@@ -318,7 +400,7 @@ class TokenRefresherManager(object):
                 stored = self.implementer.store_credentials(owner_id, client_app_id, channeltemplate_id,
                                                             new_credentials)
                 if stored:
-                    self.db.set_credentials(new_credentials, client_app_id, owner_id, channel_id)
+                    stored_credentials.append((dict(new_credentials), client_app_id, owner_id, channel_id))
                     updated_credentials.append(key)
                 else:
                     logger.verbose(f'[update_credentials] Ignoring key {key}')
@@ -327,6 +409,8 @@ class TokenRefresherManager(object):
                 logger.verbose(f'[update_credentials] Ignoring key {key}')
                 error_keys.append(key)
 
+        self.db.set_credentials_many(stored_credentials)
+
         return list(set(updated_credentials)), list(set(error_keys))
 
     def check_credentials_man_id(self, credentials_check, new_credentials):
@@ -178,25 +178,34 @@ class WebhookHubDevice(WebhookHubBase):
                     ignore_keys = []
                     old_credentials = {}
                     channel_id = None
+                    stored_credentials = {
+                        cred_['key']: cred_['value'] for cred_ in
+                        self.db.get_credentials_many([(owner_id, channel['id']) for channel in channels])
+                    }
+                    new_credentials = []
                     for channel in channels:
                         channel_id = channel['id']
+                        key = f'credential-owners/{owner_id}/channels/{channel_id}'
                         credentials = self.implementer.auth_response(credentials)
                         credentials = self.implementer.update_expiration_date(credentials)
-                        old_credentials = self.implementer.auth_response(
-                            self.db.get_credentials(client_id, owner_id, channel_id))
+                        old_credentials = stored_credentials.get(key) or \
+                            self.db.get_credentials(client_id, owner_id, channel_id)
+                        old_credentials = self.implementer.auth_response(old_credentials)
                         if 'client_man_id' not in old_credentials:
                             credentials, has_error = self.implementer.check_manager_client_id(
                                 owner_id, channel_id, credentials, old_credentials)
                         else:
                             credentials['client_man_id'] = old_credentials['client_man_id']
-                        self.db.set_credentials(credentials, client_id, owner_id, channel_id)
+                        credentials['client_id'] = client_id
+                        new_credentials.append((dict(credentials), client_id, owner_id, channel_id))
 
-                        ignore_keys.append(f'credential-owners/{owner_id}/channels/{channel_id}')
+                        ignore_keys.append(key)
+                    self.db.set_credentials_many(new_credentials)
                     self.thread_pool.add_task(handle_credentials, credentials, old_credentials, client_id, owner_id,
                                               channel_id, ignore_keys)
                 else:
-                    for channel in channels:
-                        self.db.set_credentials(credentials, client_id, owner_id, channel['id'])
+                    self.db.set_credentials_many([(credentials, client_id, owner_id, channel['id'])
+                                                  for channel in channels])
 
         logger.info(f"Channels: {channels}")
 
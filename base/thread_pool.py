@@ -1,88 +1,149 @@
-import sys
-import json
 import threading
 import traceback
-from time import sleep
+from time import sleep, perf_counter, monotonic
 from functools import wraps
 from base import logger, settings
 from base.redis_db import get_redis
-from base.constants import DEFAULT_THREAD_POOL_NAME, DEFAULT_THREAD_KEY_NAME, DEFAULT_SLEEP_TIME
+from base.work_queue import WorkQueue
+from base.exceptions import TaskCancelledException
+from base.constants import DEFAULT_THREAD_POOL_NAME, DEFAULT_THREAD_KEY_NAME, DEFAULT_SLEEP_TIME, \
+    DEFAULT_BLOCK_TIMEOUT, DEFAULT_VISIBILITY_TIMEOUT, DEFAULT_MAX_DELIVERIES, DEFAULT_DISPATCH_MODE, \
+    DEFAULT_BATCH_SIZE, DISPATCH_POLL
 
+DISPATCH_MODE = settings.config_thread_pool.get('dispatch_mode', DEFAULT_DISPATCH_MODE)
+BATCH_SIZE = max(int(settings.config_thread_pool.get('batch_size', DEFAULT_BATCH_SIZE)), 1)
 SLEEP_TIME = settings.config_thread_pool.get('sleep_time', DEFAULT_SLEEP_TIME)
+BLOCK_TIMEOUT = settings.config_thread_pool.get('block_timeout', DEFAULT_BLOCK_TIMEOUT)
+VISIBILITY_TIMEOUT = settings.config_thread_pool.get('visibility_timeout', DEFAULT_VISIBILITY_TIMEOUT)
+MAX_DELIVERIES = settings.config_thread_pool.get('max_deliveries', DEFAULT_MAX_DELIVERIES)
 THREAD_NAME = settings.config_thread_pool.get('thread_name', DEFAULT_THREAD_POOL_NAME)
 KEY_NAME = f"{DEFAULT_THREAD_KEY_NAME}{THREAD_NAME.lower()}"
 
 
+def get_work_queue(db):
+    return WorkQueue(db, KEY_NAME, VISIBILITY_TIMEOUT, MAX_DELIVERIES)
+
+
+class CancelToken:
+    """
+    Cooperative cancellation flag of a pool thread. Long running tasks should check it between steps
+    (see current_cancel_token) and stop with raise_if_cancelled, their task being delivered again later.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """ Sleeps up to timeout seconds, returning True as soon as cancelled """
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise TaskCancelledException()
+
+
+def current_cancel_token():
+    """
+    Returns the cancel token of the pool thread running the current task, or a token never cancelled
+    when called outside the thread pool
+    """
+    return getattr(threading.current_thread(), 'cancel_token', None) or CancelToken()
+
+
 class CustomPoolThread(threading.Thread):
     """ Thread executing tasks from a given tasks queue """
     def __init__(self, tasks, thread_num):
         super().__init__()
-        self.killed = False
         self.daemon = True
         self.tasks = tasks
         self.thread_num = thread_num
         self.name = f"{THREAD_NAME}-{thread_num}"
-        self.lock = threading.Lock()
         self.db = get_redis()
+        self.queue = get_work_queue(self.db)
+        self.stop_event = threading.Event()
+        self.cancel_token = CancelToken()
 
-    def start(self):
-        self.__run_backup = self.run
-        self.run = self.__run
-        super().start()
-
-    def __run(self):
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
-
-    def globaltrace(self, frame, event, arg):
-        if event == 'call':
-            return self.localtrace
-        else:
-            return None
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def stop(self):
+        """ Stops fetching tasks, the thread exits once its current task finishes """
+        self.stop_event.set()
 
-    def localtrace(self, frame, event, arg):
-        if self.killed:
-            if event == 'line':
-                raise SystemExit()
-        return self.localtrace
+    def cancel(self):
+        """ Stops fetching tasks and asks the current one to stop """
+        self.stop()
+        self.cancel_token.cancel()
 
     def kill(self):
-        self.killed = True
+        self.cancel()
 
     def register_task(self, func):
         self.tasks.update({
             default_task_name(func): func
         })
 
-    def get_function(self):
-        json_obj = {}
-        self.lock.acquire()
-        pool_queue = self.db.get_key(KEY_NAME)
-        if pool_queue:
-            json_obj = pool_queue.pop(0)
-            self.db.set_key(KEY_NAME, pool_queue)
-        self.lock.release()
+    def run_task(self, obj):
+        logger.debug(f"Found object to be executed: {obj}")
+        _func = obj.get('func')
+        _args = obj.get('args', [])
+        _kwargs = obj.get('kwargs', {})
+        if _func and _func in self.tasks:
+            logger.debug(f"Running function {_func} with args: {_args}; kwargs: {_kwargs}")
+            self.tasks[_func](*_args, **_kwargs)
+        else:
+            logger.warning(f"Task {_func} not registered on thread pool")
 
-        return json_obj
+    def get_batch(self):
+        """
+        notify mode: blocks on the queue until a task is pushed, starting it right away.
+        poll mode (legacy): checks the queue every SLEEP_TIME seconds.
+        """
+        if DISPATCH_MODE == DISPATCH_POLL:
+            batch = self.queue.get_batch(BATCH_SIZE, timeout=None)
+            if not batch:
+                self.stop_event.wait(SLEEP_TIME)
+            return batch
+        return self.queue.get_batch(BATCH_SIZE, timeout=BLOCK_TIMEOUT)
 
     def run(self):
-        while True:
-            json_obj = self.get_function()
+        while not self.stopped:
             try:
-                obj = json.loads(json_obj)
-                logger.debug(f"Found object to be executed: {obj}")
-                _func = obj.get('func')
-                _args = obj.get('args', [])
-                _kwargs = obj.get('kwargs', {})
-                if _func and _func in self.tasks:
-                    logger.debug(f"Running function {_func} with args: {_args}; kwargs: {_kwargs}")
-                    self.tasks[_func](*_args, **_kwargs)
-                sleep(SLEEP_TIME)
-            except TypeError:
-                sleep(SLEEP_TIME)
+                self.queue.requeue_expired()
+                batch = self.get_batch()
+
+                for n, (raw, obj) in enumerate(batch):
+                    if self.stopped:
+                        self.queue.release(raw)
+                        continue
+                    if n and not self.queue.touch(raw):
+                        logger.warning(f"Task {obj.get('func')} {obj.get('id')} waited in batch for longer than "
+                                       f"the visibility timeout, it was delivered again")
+                        continue
+                    start = perf_counter()
+                    try:
+                        self.run_task(obj)
+                    except TaskCancelledException:
+                        logger.warning(f"Task {obj.get('func')} cancelled, it will be delivered again")
+                        self.queue.release(raw)
+                        continue
+                    except Exception:
+                        logger.error(f"Unexpected error on thread pool task: {traceback.format_exc(limit=5)}")
+                    self.queue.ack(raw, perf_counter() - start)
+
+                if batch and DISPATCH_MODE == DISPATCH_POLL:
+                    self.stop_event.wait(SLEEP_TIME)
             except Exception:
                 logger.error(f"Unexpected error on thread pool: {traceback.format_exc(limit=5)}")
+                self.stop_event.wait(SLEEP_TIME or BLOCK_TIMEOUT)
+        logger.debug(f"[ThreadPool] {self.name} stopped")
 
 
 class ThreadPool:
@@ -91,8 +152,8 @@ class ThreadPool:
         self._tasks = {}
         self.num_threads = num_threads
         self._threads = []
-        self.lock = threading.Lock()
         self.db = get_redis()
+        self.queue = get_work_queue(self.db)
 
     @property
     def tasks(self):
@@ -104,15 +165,52 @@ class ThreadPool:
 
     def start(self):
         self.kill_threads()
+        self.queue.migrate_legacy(KEY_NAME)
         for num in range(self.num_threads):
             cpt = CustomPoolThread(self.tasks, num)
             cpt.start()
             self.threads.append(cpt)
 
     def kill_threads(self):
+        self.shutdown(deadline=0)
+
+    def stop(self):
+        """ Threads stop fetching tasks and exit after finishing the current one """
+        for t in self.threads:
+            t.stop()
+
+    def cancel(self):
+        """ Threads stop fetching tasks and running tasks are asked to stop (see CancelToken) """
         for t in self.threads:
-            t.kill()
-            t.join()
+            t.cancel()
+
+    def join(self, timeout=None):
+        """
+        Waits for all threads to exit, up to timeout seconds overall. Returns True if all of them exited
+        """
+        end = None if timeout is None else monotonic() + timeout
+        for t in self.threads:
+            t.join(None if end is None else max(end - monotonic(), 0))
+        return not any(t.is_alive() for t in self.threads)
+
+    def shutdown(self, deadline=None, cancel_timeout=None):
+        """
+        Graceful drain: threads stop fetching tasks and running ones may finish for up to deadline seconds
+        (None waits forever). Tasks still running are then cancelled and waited up to cancel_timeout seconds.
+        Returns True if all threads exited.
+        """
+        self.stop()
+        finished = self.join(deadline)
+        if not finished:
+            logger.warning(f"[ThreadPool] Tasks still running after {deadline}s, cancelling them")
+            self.cancel()
+            finished = self.join(cancel_timeout)
+        if finished:
+            self.threads.clear()
+        else:
+            logger.error(f"[ThreadPool] Threads still alive: {[t.name for t in self.threads if t.is_alive()]}")
+            self._threads = [t for t in self.threads if t.is_alive()]
+        return finished
 
     def register_task(self, func):
         self.tasks.update({
@@ -131,24 +229,31 @@ class ThreadPool:
                 'args': attrs,
                 'kwargs': kwargs
             }
-            self.lock.acquire()
-            value = json.dumps(func_obj)
-            pool_queue = self.db.get_key(KEY_NAME)
-            if not pool_queue:
-                self.db.set_key(KEY_NAME, [value])
-            else:
-                pool_queue.append(value)
-                self.db.set_key(KEY_NAME, [value])
-            self.lock.release()
+            return self.queue.put(func_obj)
+        else:
+            logger.warning(f"Task {task_name} not registered on thread pool")
 
     def map(self, func, args_list):
         """ Add a list of tasks to the queue """
         for args in args_list:
             self.add_task(func, args)
 
-    def wait_completion(self):
-        """ Wait for completion of all the tasks in the queue """
-        self.tasks.join()
+    def metrics(self):
+        """ Queue depth, tasks in flight, delivery counters and average wait/run times """
+        return self.queue.metrics()
+
+    def wait_completion(self, timeout=None, interval=0.1):
+        """
+        Wait for completion of all the tasks in the queue, up to timeout seconds. Returns True if completed
+        """
+        end = None if timeout is None else monotonic() + timeout
+        while True:
+            metrics = self.metrics()
+            if not metrics['depth'] and not metrics['in_flight']:
+                return True
+            if end is not None and monotonic() >= end:
+                return False
+            sleep(interval)
 
 
 def pool_task(func):
@@ -1,7 +1,4 @@
 import json
-import threading
-import time
-from functools import wraps
 from uuid import UUID
 from typing import AnyStr
 
@@ -39,35 +36,12 @@ def is_json(str_value):
     return True
 
 
-def rate_limited(max_per_second: int):
+def rate_limited(max_per_second: int, burst=1, max_concurrency=None, shared_key=None):
     """
-        Rate-limits the decorated function locally, for one process.
-        source: https://gist.github.com/gregburek/1441055#gistcomment-945625
+        Rate-limits the decorated function with a token bucket, see base.rate_limiter.rate_limited
     """
-    lock = threading.Lock()
-    min_interval = 1.0 / max_per_second
-
-    def decorate(func):
-        last_time_called = time.perf_counter()
-
-        @wraps(func)
-        def rate_limited_function(*args, **kwargs):
-            lock.acquire()
-            nonlocal last_time_called
-            try:
-                elapsed = time.perf_counter() - last_time_called
-                left_to_wait = min_interval - elapsed
-                if left_to_wait > 0:
-                    time.sleep(left_to_wait)
-
-                return func(*args, **kwargs)
-            finally:
-                last_time_called = time.perf_counter()
-                lock.release()
-
-        return rate_limited_function
-
-    return decorate
+    from base.rate_limiter import rate_limited as token_bucket_rate_limited
+    return token_bucket_rate_limited(max_per_second, burst, max_concurrency, shared_key)
 
 
 def mask_token(token):
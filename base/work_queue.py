@@ -0,0 +1,255 @@
+import json
+import time
+import uuid
+import traceback
+
+from base import settings, logger
+
+MIGRATION_LOCK_TIMEOUT = 60  # seconds
+
+# Restarts the visibility timeout of task ARGV[1] in deadlines sorted set KEYS[1] to ARGV[2], only if it's still
+# there (not acknowledged, nor expired and delivered again). Returns 1 if restarted
+TOUCH_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Removes task ARGV[1] from deadlines sorted set KEYS[1] and processing list KEYS[2] if its deadline is before
+# ARGV[2] (now), so only one worker delivers it again, and not after its worker restarted its visibility timeout.
+# Returns 1 if it was still being processed (not acknowledged nor released meanwhile)
+EXPIRE_SCRIPT = """
+local deadline = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if deadline and tonumber(deadline) <= tonumber(ARGV[2]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    return redis.call('LREM', KEYS[2], 1, ARGV[1])
+end
+return 0
+"""
+
+# Moves up to ARGV[1] tasks from pending list KEYS[1] to processing list KEYS[2] and sets their deadline ARGV[2]
+# in sorted set KEYS[3], in one step, so a worker dying meanwhile leaves no fetched task without deadline.
+# ARGV[3], if given, is a task already moved by BRPOPLPUSH, first of the batch. Returns the tasks fetched
+FETCH_SCRIPT = """
+local tasks = {}
+if ARGV[3] then
+    tasks[1] = ARGV[3]
+end
+while #tasks < tonumber(ARGV[1]) do
+    local task = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not task then
+        break
+    end
+    tasks[#tasks + 1] = task
+end
+for _, task in ipairs(tasks) do
+    redis.call('ZADD', KEYS[3], ARGV[2], task)
+end
+return tasks
+"""
+
+# Sets deadline ARGV[1] in sorted set KEYS[2] to the tasks of processing list KEYS[1] without one: moved by a
+# blocking pop (BRPOPLPUSH) whose worker died before FETCH_SCRIPT, they're delivered again once it expires.
+# Returns the number of tasks found without deadline
+ORPHANS_SCRIPT = """
+local orphans = 0
+for _, task in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if not redis.call('ZSCORE', KEYS[2], task) then
+        redis.call('ZADD', KEYS[2], ARGV[1], task)
+        orphans = orphans + 1
+    end
+end
+return orphans
+"""
+
+
+class WorkQueue:
+    """
+    Reliable FIFO queue of tasks shared by all threads and processes using the same redis hash.
+
+    Tasks are moved atomically from the pending list to a processing list when fetched, with their visibility
+    deadline, and stay there until acknowledged. A task not acknowledged within visibility_timeout seconds
+    (e.g. its worker died) is delivered again, up to max_deliveries times.
+    """
+
+    def __init__(self, db, name, visibility_timeout, max_deliveries):
+        self.db = db
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.max_deliveries = max_deliveries
+        self.key = f"{settings.redis_db}/{name}"
+        self.processing_key = f"{self.key}/processing"
+        self.deadlines_key = f"{self.key}/deadlines"
+        self.metrics_key = f"{self.key}/metrics"
+        self._touch_script = None
+        self._expire_script = None
+        self._fetch_script = None
+        self._orphans_script = None
+
+    def put(self, task: dict):
+        """
+        Appends a task ({'func': ..., 'args': [...], 'kwargs': {...}}) to the queue
+        """
+        pipe = self.db.pipeline()
+        task_id = self._put(pipe, task)
+        pipe.execute()
+        return task_id
+
+    def _put(self, pipe, task):
+        task = dict(task, id=uuid.uuid4().hex, enqueued_at=time.time(), delivery=1)
+        pipe.lpush(self.key, json.dumps(task))
+        pipe.hincrby(self.metrics_key, 'enqueued', 1)
+        return task['id']
+
+    def get(self, timeout=0):
+        """
+        Blocks up to timeout seconds (0 waits forever) for the next task.
+        Returns (raw, task), raw being required to ack the task, or (None, None) on timeout
+        """
+        batch = self.get_batch(1, timeout)
+        return batch[0] if batch else (None, None)
+
+    def get_batch(self, size, timeout=0):
+        """
+        Blocks up to timeout seconds (0 waits forever, None doesn't block) for the next task and fetches up to
+        size - 1 more already waiting, in one round trip. Returns a list of (raw, task)
+        """
+        if self._fetch_script is None:
+            self._fetch_script = self.db.register_script(FETCH_SCRIPT)
+        blocked = []
+        if timeout is not None:
+            # blocks outside of the script, a task left without deadline meanwhile is covered by requeue_expired
+            raw = self.db.brpoplpush(self.key, self.processing_key, timeout)
+            if raw is None:
+                return []
+            blocked.append(raw)
+
+        now = time.time()
+        raw_list = self._fetch_script(keys=[self.key, self.processing_key, self.deadlines_key],
+                                      args=[size, repr(now + self.visibility_timeout)] + blocked)
+        if not raw_list:
+            return []
+
+        batch = [(raw_, json.loads(raw_)) for raw_ in raw_list]
+        wait_time = sum(max(now - task.get('enqueued_at', now), 0) for _, task in batch)
+        pipe = self.db.pipeline()
+        pipe.hincrby(self.metrics_key, 'delivered', len(batch))
+        pipe.hincrbyfloat(self.metrics_key, 'wait_time', wait_time)
+        pipe.execute()
+        return batch
+
+    def touch(self, raw):
+        """
+        Restarts the visibility timeout of a fetched task, e.g. when it waited in a batch before running.
+        Returns False if the task can't be run anymore: its visibility timeout expired meanwhile and it was
+        delivered again (or dropped)
+        """
+        if self._touch_script is None:
+            self._touch_script = self.db.register_script(TOUCH_SCRIPT)
+        return bool(self._touch_script(keys=[self.deadlines_key],
+                                       args=[raw, repr(time.time() + self.visibility_timeout)]))
+
+    def ack(self, raw, run_time=0.0):
+        """
+        Removes a fetched task from the processing list, it won't be delivered again
+        """
+        pipe = self.db.pipeline()
+        pipe.lrem(self.processing_key, raw, 1)
+        pipe.zrem(self.deadlines_key, raw)
+        pipe.hincrby(self.metrics_key, 'acked', 1)
+        pipe.hincrbyfloat(self.metrics_key, 'run_time', run_time)
+        pipe.execute()
+
+    def release(self, raw):
+        """
+        Puts back a fetched task not processed (e.g. worker stopping) at the head of the queue, unless it was
+        already delivered again
+        """
+        if not self.db.zrem(self.deadlines_key, raw):
+            return
+        pipe = self.db.pipeline()
+        pipe.lrem(self.processing_key, raw, 1)
+        pipe.rpush(self.key, raw)
+        pipe.execute()
+
+    def requeue_expired(self):
+        """
+        Delivers again every task whose visibility timeout has expired without being acknowledged
+        """
+        n_requeued = 0
+        now = time.time()
+        if self._expire_script is None:
+            self._expire_script = self.db.register_script(EXPIRE_SCRIPT)
+            self._orphans_script = self.db.register_script(ORPHANS_SCRIPT)
+        self._orphans_script(keys=[self.processing_key, self.deadlines_key],
+                             args=[repr(now + self.visibility_timeout)])
+        for raw in self.db.zrangebyscore(self.deadlines_key, '-inf', now):
+            if not self._expire_script(keys=[self.deadlines_key, self.processing_key], args=[raw, repr(now)]):
+                continue  # already acknowledged, touched or requeued by another worker
+
+            task = json.loads(raw)
+            pipe = self.db.pipeline()
+            if task.get('delivery', 1) < self.max_deliveries:
+                task['delivery'] = task.get('delivery', 1) + 1
+                logger.warning(f"[WorkQueue] {self.name}: task {task.get('func')} {task.get('id')} not acknowledged "
+                               f"in {self.visibility_timeout}s, delivery {task['delivery']}")
+                pipe.rpush(self.key, json.dumps(task))
+                pipe.hincrby(self.metrics_key, 'redelivered', 1)
+                n_requeued += 1
+            else:
+                logger.error(f"[WorkQueue] {self.name}: dropping task {task.get('func')} {task.get('id')} after "
+                             f"{self.max_deliveries} deliveries")
+                pipe.hincrby(self.metrics_key, 'dropped', 1)
+            pipe.execute()
+        return n_requeued
+
+    def migrate_legacy(self, db_key):
+        """
+        Moves tasks stored as a json list in a hash field (old thread pool format) to this queue.
+        Processes starting at the same time migrate them once: the migration holds a lock (SET NX), and the
+        tasks are queued and the hash field deleted in one transaction
+        """
+        lock_name = f"{self.name}/migration"
+        try:
+            lock = self.db.acquire_lock(lock_name, MIGRATION_LOCK_TIMEOUT)
+            if lock is None:
+                logger.info(f"[WorkQueue] {self.name}: legacy queue being migrated by another process")
+                return
+            try:
+                legacy_queue = self.db.get_key(db_key) if self.db.has_key(db_key) else None
+                if legacy_queue is None:
+                    return
+
+                pipe = self.db.pipeline()
+                for value in legacy_queue or []:
+                    self._put(pipe, json.loads(value) if type(value) is str else value)
+                pipe.hdel(settings.redis_db, db_key)
+                pipe.execute()
+                logger.notice(f"[WorkQueue] {self.name}: {len(legacy_queue or [])} legacy tasks migrated")
+            finally:
+                self.db.release_lock(lock_name, lock)
+        except Exception:
+            logger.error(f"[WorkQueue] Failed to migrate legacy queue {db_key}: {traceback.format_exc(limit=5)}")
+
+    def metrics(self):
+        """
+        Returns queue depth, tasks in flight, counters and average wait/run times in seconds
+        """
+        pipe = self.db.pipeline()
+        pipe.llen(self.key)
+        pipe.llen(self.processing_key)
+        pipe.hgetall(self.metrics_key)
+        depth, in_flight, counters = pipe.execute()
+
+        metrics = {
+            'depth': depth,
+            'in_flight': in_flight,
+        }
+        for counter in ('enqueued', 'delivered', 'acked', 'redelivered', 'dropped'):
+            metrics[counter] = int(counters.get(counter, 0))
+        metrics['avg_wait_time'] = float(counters.get('wait_time', 0)) / metrics['delivered'] \
+            if metrics['delivered'] else 0.0
+        metrics['avg_run_time'] = float(counters.get('run_time', 0)) / metrics['acked'] if metrics['acked'] else 0.0
+        return metrics
@@ -0,0 +1,6 @@
+"""
+Micro-benchmarks of the manager hot paths. Run them from the repository root with a manager configuration,
+optionally giving the number of iterations:
+
+        python -m benchmarks.bench_redis_db path_to_conf [iterations]
+"""
@@ -0,0 +1,97 @@
+"""
+Logging on the mqtt hot path: time spent by the mqtt network thread in MqttConnector.on_message (parsed handoff,
+debug level, two records per message) with the sync handler and the queue handler ($log.mode), writing to a
+temporary file, with and without handler stalls (2 ms every 100 records, as a slow disk or syslog socket).
+
+        python -m benchmarks.bench_logging path_to_conf [iterations]
+"""
+import os
+import json
+import queue
+import tempfile
+import time
+
+from benchmarks.common import iterations, report
+from base import logger, settings, mqtt_connector
+from base import python_logging as pl
+from base.mqtt_connector import MqttConnector
+from base.constants import MESSAGE_HANDOFF_PARSED, DEFAULT_LOG_QUEUE_SIZE, DEFAULT_LOG_OVERFLOW
+
+N = iterations(20000)
+DEBUG = pl.log_levels['DEBUG'][1]
+STALL_EVERY = 100
+STALL_TIME = 0.002
+
+
+class Message:
+    """ A write request as received from paho """
+    topic = '/v3/managers/manager-id/channels/channel-id/components/component/properties/property/value'
+    payload = json.dumps({
+        'io': 'w',
+        'sender': 's' * 36,
+        'on_behalf_of': 'o' * 36,
+        'data': {'value': 21.5, 'unit': 'C', 'access_token': 'a' * 40}
+    }).encode()
+
+
+def file_handler(log_path, stall):
+    """ The configured handler writing to log_path, stalling STALL_TIME every STALL_EVERY records if stall """
+    handler = pl.setup_logger_handler(log_path, DEBUG, logger.log_type, settings.host_pub)
+    if stall:
+        emit, records = handler.emit, [0]
+
+        def stalling_emit(record):
+            records[0] += 1
+            if records[0] % STALL_EVERY == 0:
+                time.sleep(STALL_TIME)
+            emit(record)
+        handler.emit = stalling_emit
+    return handler
+
+
+def bench_mode(mode, stall, log_path):
+    handler = file_handler(log_path, stall)
+    listener = None
+    if mode == 'queue':
+        handler, listener = pl.setup_queue_handler(handler, DEFAULT_LOG_QUEUE_SIZE, DEFAULT_LOG_OVERFLOW,
+                                                   escape=logger.log_type == 'json')
+        listener.start()
+    logger.queued = listener is not None
+    logger.handlers = [handler]
+
+    mqtt = MqttConnector(queue=queue.SimpleQueue())
+    message = Message()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(N):
+        call_start = time.perf_counter()
+        mqtt.on_message(None, 0, message)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    if listener is not None:
+        listener.stop()
+
+    latencies.sort()
+    name = f"  {mode}, {'stalls' if stall else 'no stalls'}:"
+    report(f"{name} on_message", N / elapsed, 'msg/s')
+    report(f"{name} on_message p50", latencies[N // 2] * 1e6, 'us')
+    report(f"{name} on_message p99", latencies[int(N * 0.99)] * 1e6, 'us')
+    if listener is not None:
+        report(f"{name} records dropped (queue full)", handler.dropped, 'records')
+
+
+if __name__ == "__main__":
+    handlers, level, queued = logger.handlers, logger.level, getattr(logger, 'queued', False)
+    mqtt_connector.MESSAGE_HANDOFF = MESSAGE_HANDOFF_PARSED
+    logger.setLevel(DEBUG)
+    log_fd, log_path = tempfile.mkstemp(suffix='.log')
+    os.close(log_fd)
+    print(f"Logging on on_message, {N} messages, {logger.log_type} format, log file {log_path}")
+    try:
+        for stall in (False, True):
+            for mode in ('sync', 'queue'):
+                bench_mode(mode, stall, log_path)
+    finally:
+        logger.handlers, logger.queued = handlers, queued
+        logger.setLevel(level)
+        os.remove(log_path)
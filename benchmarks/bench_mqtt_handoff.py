@@ -0,0 +1,61 @@
+"""
+Mqtt subscription handoff: messages queued by MqttConnector.on_message (mqtt network thread) and taken by a
+subscriber process, with the raw handoff (payload parsed by the subscriber) and the parsed one (payload parsed
+by the network thread). No broker is needed, on_message is called directly.
+
+        python -m benchmarks.bench_mqtt_handoff path_to_conf [iterations]
+"""
+import json
+import time
+import multiprocessing as mp
+
+from benchmarks.common import iterations, report
+from base import mqtt_connector
+from base.mqtt_connector import MqttConnector
+from base.constants import MESSAGE_HANDOFF_RAW, MESSAGE_HANDOFF_PARSED
+
+N = iterations(50000)
+
+
+class Message:
+    """ A write request as received from paho """
+    topic = '/v3/managers/manager-id/channels/channel-id/components/component/properties/property/value'
+    payload = json.dumps({
+        'io': 'w',
+        'sender': 's' * 36,
+        'on_behalf_of': 'o' * 36,
+        'data': {'value': 21.5, 'unit': 'C', 'history': list(range(20))}
+    }).encode()
+
+
+def consume(message_queue, results):
+    """ Subscriber process side: takes the N messages, parsing the raw ones """
+    mqtt = MqttConnector(queue=message_queue)
+    start = time.perf_counter()
+    for _ in range(N):
+        item = message_queue.get()
+        if isinstance(item, tuple):
+            item = mqtt.parse_message(*item)
+    results.put(N / (time.perf_counter() - start))
+
+
+def bench_handoff(handoff):
+    mqtt_connector.MESSAGE_HANDOFF = handoff  # read by on_message, inherited by the forked subscriber
+    message_queue, results = mp.Queue(), mp.Queue()
+    subscriber = mp.Process(target=consume, args=(message_queue, results))
+    subscriber.start()
+
+    mqtt = MqttConnector(queue=message_queue)
+    message = Message()
+    start = time.perf_counter()
+    for _ in range(N):
+        mqtt.on_message(None, 0, message)
+    report(f"  {handoff}: on_message (network thread)", N / (time.perf_counter() - start), 'msg/s')
+    report(f"  {handoff}: subscriber process", results.get(), 'msg/s')
+    subscriber.join()
+
+
+if __name__ == "__main__":
+    print(f"Mqtt handoff, {N} messages of {len(Message.payload)} bytes each")
+    for mode in (MESSAGE_HANDOFF_RAW, MESSAGE_HANDOFF_PARSED):
+        bench_handoff(mode)
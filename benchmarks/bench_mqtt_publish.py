@@ -0,0 +1,55 @@
+"""
+Mqtt publish path: sustained publishes of property values through MqttConnector.publisher (one at a time) and
+publish_batch. No broker is needed, the paho publish of each connection is replaced by a stub, so this measures
+the manager side only: credentials check, topic, payload serialization, counters and logs.
+
+        python -m benchmarks.bench_mqtt_publish path_to_conf [iterations]
+"""
+import itertools
+
+from benchmarks.common import iterations, measure, report
+from base import redis_db
+from base.mqtt_connector import MqttConnector
+
+N = iterations(100000)
+CHANNELS = 500
+BATCH_SIZE = 50
+
+
+def stub_publish(mqtt):
+    """ Replaces the paho publish of every connection, returning success and a new mid """
+    mids = itertools.count(1)
+    for mqtt_client in mqtt.mqtt_clients:
+        mqtt_client.publish = lambda topic, payload, qos=0, retain=False: (0, next(mids))
+
+
+def publishes():
+    """ Cycles through temperature values of CHANNELS channels """
+    for n in itertools.count():
+        yield {
+            'io': 'iw',
+            'data': {'value': n * 0.5, 'unit': 'C'},
+            'case': {'channel_id': f'channel-{n % CHANNELS:04d}', 'component': 'thermostat',
+                     'property': 'temperature'}
+        }
+
+
+def bench_publish():
+    mqtt = MqttConnector(access_token='benchmark')
+    stub_publish(mqtt)
+    items = publishes()
+    print(f"Mqtt publish, {N} publishes over {CHANNELS} channels, {len(mqtt.mqtt_clients)} connections "
+          f"(orjson {'enabled' if redis_db.orjson else 'not installed'})")
+
+    def publish_one():
+        item = next(items)
+        mqtt.publisher(item['io'], item['data'], item['case'])
+
+    batches = ([next(items) for _ in range(BATCH_SIZE)] for _ in itertools.count())
+    report("  publisher", measure(publish_one, N), 'publishes/s')
+    report(f"  publish_batch, batches of {BATCH_SIZE}",
+           measure(lambda: mqtt.publish_batch(next(batches)), N // BATCH_SIZE) * BATCH_SIZE, 'publishes/s')
+
+
+if __name__ == "__main__":
+    bench_publish()
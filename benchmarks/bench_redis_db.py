@@ -0,0 +1,92 @@
+"""
+DB layer: decoding of stored values, previous decoders (literal_eval / json.loads fallbacks) against the
+tagged value encoding, and redis round trips of get_key, get_keys and full_query.
+
+        python -m benchmarks.bench_redis_db path_to_conf [iterations]
+"""
+import ast
+import json
+
+from redis.exceptions import ConnectionError
+
+from benchmarks.common import iterations, measure, report, benchmark_hash
+from base import redis_db
+from base.redis_db import encode_value, decode_value, get_redis
+
+N = iterations(20000)
+
+CREDENTIALS = {
+    'access_token': 'a' * 64,
+    'refresh_token': 'r' * 64,
+    'token_type': 'Bearer',
+    'expires_in': 3600,
+    'expiration_date': 1700000000,
+    'scope': 'read write devices',
+    'client_id': 'c' * 36,
+    'client_man_id': 'm' * 36,
+    'data': {'user_id': 'u' * 36, 'devices': [f'device-{n}' for n in range(20)]}
+}
+VALUES = {
+    'credentials': CREDENTIALS,
+    'channels list': [f'channel-{n:04d}' for n in range(50)],
+    'device id': 'd' * 36
+}
+
+
+def previous_get_key_decode(value):
+    """ get_key before the value encoding: literal_eval first, then json """
+    try:
+        return ast.literal_eval(value)
+    except Exception:
+        try:
+            return json.loads(value)
+        except Exception:
+            return value
+
+
+def previous_query_decode(value):
+    """ query / full_query before the value encoding: json first, then literal_eval """
+    try:
+        return json.loads(value)
+    except Exception:
+        try:
+            return ast.literal_eval(value)
+        except Exception:
+            return value
+
+
+def bench_decoding():
+    print(f"Decoding, {N} values each (orjson {'enabled' if redis_db.orjson else 'not installed'})")
+    for name, value in VALUES.items():
+        legacy = json.dumps(value) if type(value) is dict else str(value)
+        tagged = encode_value(value)
+        report(f"  {name}: previous get_key decoding", measure(lambda: previous_get_key_decode(legacy), N))
+        report(f"  {name}: previous query decoding", measure(lambda: previous_query_decode(legacy), N))
+        report(f"  {name}: decode_value, legacy value", measure(lambda: decode_value(legacy), N))
+        report(f"  {name}: decode_value, tagged value", measure(lambda: decode_value(tagged), N))
+        report(f"  {name}: encode_value", measure(lambda: encode_value(value), N))
+
+
+def bench_redis():
+    hash_name = benchmark_hash()
+    db = get_redis()
+    n_keys = 100
+    keys = [f'credential-owners/owner-{n}/channels/channel-{n}' for n in range(n_keys)]
+    print(f"Redis round trips, {N // 10} calls each, hash {hash_name}")
+    try:
+        db.delete(hash_name)
+        db.set_keys({key: dict(CREDENTIALS) for key in keys})
+        report("  get_key (HGET)", measure(lambda: db.get_key(keys[0]), N // 10))
+        report(f"  get_keys, {n_keys} keys (HMGET)", measure(lambda: db.get_keys(keys), N // 100) * n_keys,
+               'keys/s')
+        report(f"  full_query, {n_keys} keys (HSCAN)",
+               measure(lambda: db.full_query('credential-owners/*/channels/*'), N // 100) * n_keys, 'keys/s')
+    except ConnectionError as e:
+        print(f"  redis unavailable, skipped: {e}")
+    else:
+        db.delete(hash_name)
+
+
+if __name__ == "__main__":
+    bench_decoding()
+    bench_redis()
@@ -0,0 +1,77 @@
+"""
+Thread pool: tasks run by a pool thread, with the previous kill mechanism (a sys.settrace hook checking the
+kill flag on every line of the thread) against cooperative cancellation (no hook).
+
+        python -m benchmarks.bench_thread_pool path_to_conf [iterations]
+"""
+import sys
+import json
+import threading
+
+from benchmarks.common import iterations, measure, report
+from base.thread_pool import CustomPoolThread, default_task_name
+
+N = iterations(2000)
+
+
+class PreviousPoolThread(CustomPoolThread):
+    """ Pool thread before cooperative cancellation: killed by a trace hook raising SystemExit """
+    killed = False
+
+    def globaltrace(self, frame, event, arg):
+        if event == 'call':
+            return self.localtrace
+        return None
+
+    def localtrace(self, frame, event, arg):
+        if self.killed:
+            if event == 'line':
+                raise SystemExit()
+        return self.localtrace
+
+
+def empty_task():
+    pass
+
+
+def credentials_task(owner_id):
+    """ Pure python work similar to a credentials update: a document per channel, serialized """
+    channels = {}
+    for n in range(50):
+        channel_id = f'channel-{n:04d}'
+        channels[channel_id] = {
+            'owner_id': owner_id,
+            'access_token': f'{owner_id}-{n}',
+            'devices': [f'{channel_id}-device-{d}' for d in range(5)]
+        }
+    return json.loads(json.dumps(channels))
+
+
+def run_in_thread(pool_thread, task, args, trace):
+    """ Runs the task n times through run_task in a new thread, with the pool thread trace hook if trace """
+    tasks = {default_task_name(task): task}
+    pool_thread.tasks = tasks
+    obj = {'func': default_task_name(task), 'args': args, 'kwargs': {}}
+    result = {}
+
+    def target():
+        if trace:
+            sys.settrace(pool_thread.globaltrace)
+        result['rate'] = measure(lambda: pool_thread.run_task(obj), N)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    return result['rate']
+
+
+def bench_tasks():
+    print(f"Pool thread tasks, {N} tasks each")
+    current, previous = CustomPoolThread({}, 0), PreviousPoolThread({}, 0)
+    for name, task, args in (('empty task', empty_task, []), ('credentials task', credentials_task, ['owner'])):
+        report(f"  {name}: previous (settrace hook)", run_in_thread(previous, task, args, True), 'tasks/s')
+        report(f"  {name}: cooperative cancellation", run_in_thread(current, task, args, False), 'tasks/s')
+
+
+if __name__ == "__main__":
+    bench_tasks()
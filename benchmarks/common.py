@@ -0,0 +1,30 @@
+import sys
+import time
+
+from base import settings
+
+
+def iterations(default):
+    """ Number of iterations, given after the configuration path """
+    return int(sys.argv[2]) if len(sys.argv) > 2 else default
+
+
+def measure(func, n):
+    """ Calls func n times, returns the calls per second """
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return n / (time.perf_counter() - start)
+
+
+def report(name, rate, unit='ops/s'):
+    print(f"{name:<50} {rate:>14,.0f} {unit}", flush=True)
+
+
+def benchmark_hash():
+    """
+    Points the DB layer to a separate redis hash, so benchmarks never read or write the manager data.
+    Returns its name
+    """
+    settings.redis_db = f"{settings.redis_db}/benchmark"
+    return settings.redis_db
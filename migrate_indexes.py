@@ -0,0 +1,23 @@
+"""
+Builds the secondary indexes of an existing redis hash. Run it after enabling the indexed mode
+("indexed": true in the redis managers configuration) and restarting every manager with stored data:
+
+        python migrate_indexes.py path_to_conf
+"""
+import os
+import traceback
+
+from base import logger
+from base.redis_db import get_redis
+
+if __name__ == "__main__":
+    try:
+        print('[Migration]: Building redis indexes...')
+        n_keys = get_redis().build_indexes()
+        if n_keys is None:
+            print('[Migration]: Failed, check log file for details')
+            os._exit(1)
+        print('[Migration]: {} keys indexed'.format(n_keys))
+    except Exception:
+        logger.critical("[Migration]: Unexpected error {}".format(traceback.format_exc(limit=5)))
+        raise
@@ -0,0 +1,58 @@
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+import fakeredis
+import pytest
+
+# base.settings reads the configuration file given as first argument when imported
+CONFIG = {
+    "$log": {"level": 7, "file": os.path.join(tempfile.gettempdir(), "manager-sdk-tests.log"), "format": "pretty"},
+    "boot": [{
+        "rest": {
+            "version": "v3",
+            "credentials": {
+                "client_id": "test-client",
+                "client_secret": "test-secret",
+                "server": "https://api.test",
+                "grant_type": "client_credentials",
+                "scope": "manager"
+            }
+        },
+        "modules": {"skeleton_implementation": ""},
+        "tls": {"cert": ""},
+        "http": {"bind": "http://localhost:60700", "public": "https://manager.test"},
+        "redis": {"managers": {"bind": "localhost:6379", "db": "manager/Persistence/test-client"}},
+        "token_refresher": {"enabled": False, "interval_seconds": 60, "before_expires_seconds": 300}
+    }]
+}
+
+_, CONFIG_PATH = tempfile.mkstemp(suffix='.json')
+with open(CONFIG_PATH, 'w') as config_file:
+    json.dump(CONFIG, config_file)
+sys.argv[1:] = [CONFIG_PATH]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import base.redis_db as redis_db  # noqa: E402, needs the configuration above
+
+
+# fakeredis runs lua scripts with lupa
+requires_lua = pytest.mark.skipif(importlib.util.find_spec('lupa') is None, reason="lupa not installed")
+
+
+def register_script(self, script):
+    """ fakeredis has no EVALSHA, scripts are run with EVAL """
+    return lambda keys=(), args=(), client=None: (client or self).eval(script, len(keys), *keys, *args)
+
+
+@pytest.fixture
+def db():
+    """ DBManager on fakeredis """
+    attributes = {k: v for k, v in vars(redis_db.DBManager).items() if k not in ('__dict__', '__weakref__')}
+    db_class = type('FakeDBManager', (fakeredis.FakeRedis,), dict(attributes, register_script=register_script))
+    db = db_class(decode_responses=True)
+    db.credentials_key = redis_db.DBManager.credentials_key
+    db.flushall()
+    return db
@@ -0,0 +1,24 @@
+import pytest
+
+from base.skeleton_device import polling
+from base.skeleton_device.polling import PollingManager
+from base.constants import POLLING_VALIDATORS_REDIS
+
+
+@pytest.fixture
+def poller(monkeypatch, db):
+    monkeypatch.setattr(polling, 'get_redis', lambda: db)
+    manager = PollingManager()
+    manager.validators_store = POLLING_VALIDATORS_REDIS
+    return manager
+
+
+def test_validators_of_deleted_channels_are_dropped(poller):
+    poller.set_validators('channel-1 /devices/1', {'ETag': '"a"'})
+    poller.set_validators('channel-2 /devices/2', {'ETag': '"b"'})
+
+    poller.forget_validators(['channel-1'])
+
+    assert poller.db.hkeys(poller.validators_key) == ['channel-1 /devices/1']
+    assert list(poller.validators) == ['channel-1 /devices/1']
+    assert poller.get_validators('channel-1 /devices/1') == {'ETag': '"a"'}
@@ -0,0 +1,27 @@
+from base.publish_tracker import PublishTracker
+
+
+def test_unacknowledged_publishes_expire_without_reading_metrics():
+    tracker = PublishTracker(window=10, ack_timeout=5)
+    start = tracker._next_expire - 5
+    for mid in range(1000):  # one publish every 0.1s, never acknowledged
+        tracker.published(0, mid, at=start + mid * 0.1)
+    tracker.acknowledged(1, 1, at=start + 100)  # ack of an unknown publish
+
+    assert len(tracker._pending) <= 2 * 5 / 0.1
+    tracker.acknowledged(1, 2, at=start + 200)
+    assert not tracker._pending
+    assert list(tracker._early) == [(1, 2)]
+    assert tracker.metrics()['expired'] == 1000
+
+
+def test_acknowledged_publish_latency():
+    tracker = PublishTracker(window=10, ack_timeout=5)
+    tracker.published(0, 1, at=100.0)
+    tracker.acknowledged(0, 1, at=100.5)
+    tracker.acknowledged(0, 2, at=101.0)  # ack received before its publish returned
+    tracker.published(0, 2, at=100.8)
+
+    metrics = tracker.metrics()
+    assert (metrics['acked'], metrics['in_flight']) == (2, 0)
+    assert abs(metrics['latency_max'] - 0.5) < 1e-9
@@ -0,0 +1,110 @@
+import pytest
+
+from base import settings
+import base.redis_db as redis_db
+from base.redis_db import decode_value
+from conftest import requires_lua
+
+VALUES = [1, -7, 2.5, True, False, None, 'text', ['a', 1, None], {'a': 1, 'b': [True, 2.5]}]
+
+
+@pytest.mark.parametrize('encoding', ['v1', 'legacy'])
+@pytest.mark.parametrize('value', VALUES, ids=repr)
+def test_set_key_round_trip(db, monkeypatch, encoding, value):
+    monkeypatch.setattr(redis_db, 'VALUE_ENCODING', encoding)
+    assert db.set_key('some-key', value)
+    assert db.get_key('some-key') == value
+    assert type(db.get_key('some-key')) is type(value)
+
+
+def test_tagged_numeric_string_stays_a_string(db):
+    assert db.set_key('device-channels/channel-1', '12345')
+    assert db.get_device_id('channel-1') == '12345'
+
+
+@pytest.mark.parametrize('stored, expected', [
+    ('1', 1),
+    ('12345', 12345),
+    ('2.5', 2.5),
+    ('True', True),
+    ('None', None),
+    ("['a', 1]", ['a', 1]),
+    ('{"a": 1}', {'a': 1}),
+    ('device-1', 'device-1'),
+])
+def test_legacy_values_decoded_as_before(stored, expected):
+    assert decode_value(stored) == expected
+    assert type(decode_value(stored)) is type(expected)
+
+
+def test_legacy_status_and_device_id_keep_their_type(db):
+    db.hset(settings.redis_db, 'status-channels/channel-1', '1')
+    db.hset(settings.redis_db, 'device-channels/channel-1', '12345')
+    assert db.get_channel_status('channel-1') == 1
+    assert db.get_device_id('channel-1') == 12345
+
+
+@requires_lua
+def test_index_keeps_keys_stored_again_after_being_read_missing(db, monkeypatch):
+    monkeypatch.setattr(redis_db, 'INDEXED', True)
+    db.set(db.index_version_key, redis_db.INDEX_VERSION)
+    db.set_key('device-channels/channel-1', 'device-1')
+    db.sadd(db.index_prefix + 'device-channels/*', 'device-channels/channel-2')  # deleted meanwhile
+    hmget = db.hmget
+    # channel-1 read missing, then stored again by another process before the stale members are removed
+    monkeypatch.setattr(db, 'hmget', lambda name, keys: [None] * len(keys) if name == settings.redis_db
+                        else hmget(name, keys))
+
+    assert db.query('device-channels/*') == []
+    assert db.smembers(db.index_prefix + 'device-channels/*') == {'device-channels/channel-1'}
+
+
+@requires_lua
+def test_expirations_keep_credentials_stored_again_after_being_read_missing(db, monkeypatch):
+    db.set_credentials({'access_token': 'a', 'expiration_date': 100}, 'app-1', 'owner-1', 'channel-1')
+    db.zadd(db.expirations_key, **{'credential-owners/owner-2/channels/channel-2': 100})  # deleted meanwhile
+    monkeypatch.setattr(db, 'get_keys', lambda keys: {})
+
+    assert db.get_expiring_credentials(200) == []
+    assert db.zrange(db.expirations_key, 0, -1) == ['credential-owners/owner-1/channels/channel-1']
+
+
+@requires_lua
+def test_refresh_token_index_keeps_credentials_stored_again_with_the_token(db, monkeypatch):
+    db.set_credentials({'refresh_token': 'refresh-1'}, 'app-1', 'owner-1', 'channel-1')
+    db.set_credentials({'refresh_token': 'refresh-1'}, 'app-1', 'owner-2', 'channel-2')
+    db.set_credentials({'refresh_token': 'refresh-2'}, 'app-1', 'owner-2', 'channel-2')  # rotated
+    index_name = db.refresh_tokens_prefix + redis_db.refresh_token_digest('refresh-1')
+    db.sadd(index_name, 'credential-owners/owner-2/channels/channel-2')  # left by a previous version
+    get_keys = db.get_keys
+    # channel-1 read with a previous token, then stored again with refresh-1 by another process
+    monkeypatch.setattr(db, 'get_keys', lambda keys: dict(get_keys(keys), **{
+        'credential-owners/owner-1/channels/channel-1': {'refresh_token': 'refresh-0'}}))
+
+    assert db.get_credentials_by_refresh_token('refresh-1') == []
+    assert db.smembers(index_name) == {'credential-owners/owner-1/channels/channel-1'}
+
+
+@requires_lua
+def test_rebuilding_indexes_keeps_serving_them(db, monkeypatch):
+    monkeypatch.setattr(redis_db, 'INDEXED', True)
+    channels = {f'device-channels/channel-{n}': f'device-{n}' for n in range(5)}
+    db.set_keys(channels)
+    assert db.build_indexes() == 5
+
+    add_to_indexes = db._add_to_indexes
+    queried = []
+
+    def add_during_build(batch_size, prefix):
+        queried.append(len(db.query('device-channels/*')))
+        n_keys = add_to_indexes(batch_size, prefix)
+        if len(queried) == 2:  # stored after the last pass
+            db.set_key('device-channels/channel-5', 'device-5')
+        return n_keys
+    monkeypatch.setattr(db, '_add_to_indexes', add_during_build)
+    other_process = db.__class__(decode_responses=True)
+
+    assert db.build_indexes() == 5
+    assert queried == [5, 5]
+    assert len(other_process.query('device-channels/*')) == 6
+    assert not list(db.scan_iter(match=f'{settings.redis_db}/index-building-*'))
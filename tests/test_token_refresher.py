@@ -0,0 +1,80 @@
+import time
+from unittest import mock
+
+import pytest
+import requests
+
+from base.skeleton_device import token_refresher
+from base.skeleton_device.token_refresher import TokenRefresherManager
+
+REFRESH_CONF = {'url': 'https://vendor.test/oauth/token'}
+DUE_KEYS = ['credential-owners/owner-1/channels/channel-1', 'credential-owners/owner-1/channels/channel-2']
+LATER_KEY = 'credential-owners/owner-2/channels/channel-3'
+
+
+class Implementer:
+
+    def auth_response(self, response_data):
+        return response_data
+
+    def update_expiration_date(self, credentials):
+        credentials['expiration_date'] = int(time.time()) + credentials['expires_in']
+        return credentials
+
+    def check_manager_client_id(self, owner_id, channel_id, credentials, new_credentials):
+        return credentials, False
+
+    def get_channel_template(self, channel_id):
+        return 'channel-template'
+
+    def store_credentials(self, owner_id, client_app_id, channeltemplate_id, credentials):
+        return True
+
+    def get_headers(self, credentials, headers):
+        return headers
+
+
+def credentials(refresh_token, expires_at):
+    return {
+        'access_token': 'access-1',
+        'refresh_token': refresh_token,
+        'expires_in': 3600,
+        'expiration_date': expires_at,
+        'client_man_id': 'manager-client'
+    }
+
+
+@pytest.fixture
+def refresher(monkeypatch, db):
+    monkeypatch.setattr(token_refresher, 'get_redis', lambda: db)
+    return TokenRefresherManager(implementer=Implementer())
+
+
+@pytest.mark.parametrize('indexed', [True, False])
+def test_refresh_updates_every_channel_sharing_the_token(refresher, indexed):
+    now = int(time.time())
+    refresher.db.set_credentials(credentials('refresh-1', now + 10), 'app-1', 'owner-1', 'channel-1')
+    refresher.db.set_credentials(credentials('refresh-1', now + 20), 'app-1', 'owner-1', 'channel-2')
+    refresher.db.set_credentials(credentials('refresh-1', now + 3600), 'app-1', 'owner-2', 'channel-3')
+    if indexed:  # set_credentials indexed them, as build_refresh_tokens would
+        refresher.db.set(refresher.db.refresh_tokens_ready_key, 1)
+        credentials_by_token = refresher.get_due_credentials_by_refresh_token()
+        assert sorted(cred_['key'] for cred_ in credentials_by_token['refresh-1']) == DUE_KEYS
+    else:  # make_requests lists every credentials, from a scan
+        credentials_by_token = refresher.get_credentials_by_refresh_token()
+        assert len(credentials_by_token['refresh-1']) == 3
+
+    response = mock.Mock(status_code=requests.codes.ok)
+    response.json.return_value = {'access_token': 'access-2', 'refresh_token': 'refresh-2', 'expires_in': 3600}
+    with mock.patch.object(token_refresher.requests, 'request', return_value=response) as request, \
+            mock.patch.object(refresher.db, 'iter_full_query', wraps=refresher.db.iter_full_query) as scan:
+        result = refresher.send_request('refresh-1', credentials_by_token['refresh-1'], REFRESH_CONF)
+
+    assert request.call_count == 1
+    assert scan.call_count == 0
+    assert result['new'] is True
+    for key in DUE_KEYS + [LATER_KEY]:
+        stored = refresher.db.get_key(key)
+        assert stored['access_token'] == 'access-2'
+        assert stored['refresh_token'] == 'refresh-2'
+    assert refresher.db.get_credentials_by_refresh_token('refresh-1') == []
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from base.work_queue import WorkQueue
+from conftest import requires_lua
+
+pytestmark = requires_lua
+
+TASK = {'func': 'tasks.handle', 'args': [1], 'kwargs': {}}
+
+
+@pytest.fixture
+def work_queue(db):
+    # expired as soon as fetched
+    return WorkQueue(db, 'test-queue', visibility_timeout=0, max_deliveries=2)
+
+
+def test_acknowledged_task_is_not_delivered_again(work_queue):
+    task_id = work_queue.put(TASK)
+    raw, task = work_queue.get(timeout=1)
+    assert task['id'] == task_id
+    work_queue.ack(raw)
+
+    assert work_queue.requeue_expired() == 0
+    assert work_queue.get_batch(1, timeout=None) == []
+    assert work_queue.metrics()['in_flight'] == 0
+
+
+def test_expired_task_is_delivered_again_then_dropped(work_queue):
+    task_id = work_queue.put(TASK)
+    raw, _ = work_queue.get(timeout=1)
+
+    assert work_queue.requeue_expired() == 1
+    assert not work_queue.touch(raw)
+    raw, task = work_queue.get(timeout=1)
+    assert (task['id'], task['delivery']) == (task_id, 2)
+
+    assert work_queue.requeue_expired() == 0  # max_deliveries reached
+    metrics = work_queue.metrics()
+    assert (metrics['depth'], metrics['in_flight'], metrics['dropped']) == (0, 0, 1)
+
+
+def test_batch_tasks_get_their_deadline_with_the_move(work_queue):
+    for _ in range(3):
+        work_queue.put(TASK)
+    batch = work_queue.get_batch(3, timeout=1)
+    assert len(batch) == 3
+    assert work_queue.db.zcard(work_queue.deadlines_key) == 3
+
+
+def test_task_moved_by_a_worker_dying_before_its_deadline_is_delivered_again(work_queue):
+    task_id = work_queue.put(TASK)
+    # worker died between its blocking pop and setting the deadline
+    work_queue.db.brpoplpush(work_queue.key, work_queue.processing_key, 1)
+
+    assert work_queue.requeue_expired() == 1
+    raw, task = work_queue.get(timeout=1)
+    assert (task['id'], task['delivery']) == (task_id, 2)
+    assert json.loads(raw) == task
+
+
+def test_released_task_is_not_delivered_twice(db):
+    work_queue = WorkQueue(db, 'test-queue', visibility_timeout=60, max_deliveries=2)
+    work_queue.put(TASK)
+    raw, _ = work_queue.get(timeout=1)
+    work_queue.release(raw)
+
+    assert work_queue.requeue_expired() == 0
+    assert len(work_queue.get_batch(2, timeout=None)) == 1